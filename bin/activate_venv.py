@@ -3,6 +3,7 @@ Find and Activate the virtual environment
 """
 import __main__
 import os
+import site
 from pathlib import Path
 import sys
 
@@ -26,6 +27,20 @@ if os.environ.get("VIRTUAL_ENV", '') != venv:
     os.environ.pop('PYTHONHOME', None)
     os.environ['PYTHONPATH'] = str(Path(venv).parent)
 
-    # restart the script using the new environment        
-    this_script = str(Path(__main__.__file__).resolve())    
-    os.execve(this_script, sys.argv, os.environ)
\ No newline at end of file
+    site_packages = Path(venv, "lib", f"python{sys.version_info[0]}.{sys.version_info[1]}", "site-packages")
+    if sys.prefix == venv:
+        # already running the venv's python, it just needs to find dwim
+        sys.path.insert(1, str(Path(venv).parent))
+    elif site_packages.is_dir():
+        # the venv was made for this version of python, so its packages can
+        # be added in place rather than paying to start the script over.
+        # They go right after the script directory, like they would if the
+        # venv's python was running.
+        script_path, rest = sys.path[:1], sys.path[1:]
+        site.addsitedir(str(site_packages))
+        added = [x for x in sys.path[len(script_path) + len(rest):] if x not in rest]
+        sys.path[:] = script_path + [str(Path(venv).parent)] + added + rest
+    else:
+        # restart the script using the new environment        
+        this_script = str(Path(__main__.__file__).resolve())    
+        os.execve(this_script, sys.argv, os.environ)
@@ -0,0 +1,340 @@
+"""
+Benchmarks for the hot paths, run against synthetic projects
+
+The generator builds projects of any size:  N physical objects spread over
+the media types (each with M sequences), matching intake spreadsheets, and
+fake ffprobe output for the QC checks.  Each benchmark is set up outside
+of the timing and run several times, and the results (median, best, and
+operations per second) are saved as JSON which can be compared against a
+saved baseline to catch regressions.
+"""
+import os
+import time
+import random
+import logging
+import shutil
+import platform
+import statistics
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+import luhn
+from .profiles import Profile
+from .project import Project
+from .model import Model, write_session, model_map, restore_unset
+from . import yamlio
+from .importer import read_rows, plan_import, execute_import
+from .index import ProjectIndex
+from .status import scan_status
+from .qc import compile_checks
+
+
+MEDIA_TYPES = ('audiocassette', 'open_reel_audio', 'betacam', 'umatic')
+
+
+def generate_barcodes(count: int, seed: int=0) -> list[str]:
+    """Unique 14 digit barcodes with valid Luhn check digits"""
+    rng = random.Random(seed)
+    numbers = rng.sample(range(10**6, 10**7), count)
+    return [luhn.append(f"400000{n:07d}") for n in numbers]
+
+
+def generate_objects(count: int, projects: int, seed: int=0) -> list[dict]:
+    """Intake rows for the physical objects, spread over the projects and
+       cycling through the media types"""
+    return [{'project': f"BENCH{i % projects:04d}",
+             'format': MEDIA_TYPES[i % len(MEDIA_TYPES)],
+             'id': barcode,
+             'title': f"Synthetic item {i}",
+             'callnumber': f"BENCH {i}"}
+            for i, barcode in enumerate(generate_barcodes(count, seed))]
+
+
+def write_intake_sheet(filename: Path, objects: list[dict]):
+    """Write an intake spreadsheet for the objects.  Only the first row of a
+       project has the project name, like the real sheets."""
+    from openpyxl import Workbook
+    columns = ['project', 'owner', 'email', 'callnumber', 'id', 'title', 'format', 'comments']
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    sheet.append(columns)
+    seen = set()
+    for obj in sorted(objects, key=lambda o: o['project']):
+        row = {'owner': "Bench Mark", 'email': "bench@example.edu", 'comments': '', **obj}
+        if obj['project'] in seen:
+            row['project'] = ''
+        seen.add(obj['project'])
+        sheet.append([row.get(c, '') for c in columns])
+    workbook.save(filename)
+
+
+def generate_tree(rootdir: Path, profile: Profile, objects: list[dict], sequences: int=None):
+    """Create the projects and physical objects.  Each physical object gets
+       the profile's sequences, and more up to the given count."""
+    rootdir.mkdir(parents=True, exist_ok=True)
+    index = ProjectIndex.for_root(rootdir)
+    by_project = {}
+    for obj in objects:
+        by_project.setdefault(obj['project'], []).append(obj)
+    for name, objs in by_project.items():
+        project = Project(rootdir, name, create=True, index=index,
+                          defaults={'descriptive_metadata.title': f"Project {name}"})
+        project.add_physical_objects(profile, [(f"AVPS_{o['id']}", o['format'], {'title': o['title']}) for o in objs])
+        if sequences:
+            for o in objs:
+                config = profile.get_po_config(o['format'])
+                for seqno in range(config.sequence_count + 1, sequences + 1):
+                    project.add_sequence(profile, f"AVPS_{o['id']}", o['format'], seqno)
+    index.close()
+
+
+def fake_probe_output(use_qc: dict, fail: bool=False) -> dict:
+    """ffprobe-like metadata which passes (or fails) the QC checks given"""
+    data = {'format': {'format_name': 'wav', 'duration': 1800.0, 'size': 1036800000},
+            'audio': [{'codec_name': 'pcm_s24le', 'bits_per_sample': 24, 'sample_rate': 96000, 'channels': 2}],
+            'video': []}
+    if fail:
+        data['audio'][0]['sample_rate'] = 44100
+    return {k: v for k, v in data.items() if k in use_qc or not use_qc}
+
+
+class Benchmark:
+    """The state shared by the benchmarks:  a scratch directory, the
+       profile, and the synthetic data"""
+    def __init__(self, profile: Profile, objects: int=100, sequences: int=2, projects: int=4,
+                 workdir: Path=None, seed: int=0):
+        self.profile = profile
+        self.sequences = sequences
+        self.objects = generate_objects(objects, min(projects, objects), seed)
+        self.workdir = Path(tempfile.mkdtemp(prefix="dwim-bench-", dir=workdir))
+        self._counter = 0
+
+
+    def scratch(self, name: str) -> Path:
+        """A new empty directory"""
+        self._counter += 1
+        path = self.workdir / f"{name}-{self._counter}"
+        path.mkdir()
+        return path
+
+
+    def close(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# each benchmark gets the Benchmark and returns (setup, run).  setup() is
+# called before each run and isn't timed, and run(state) returns the number
+# of operations that it did.
+BENCHMARKS: dict[str, Callable] = {}
+
+def benchmark(name: str):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+@benchmark("project_create")
+def bench_project_create(b: Benchmark):
+    def setup():
+        return b.scratch("create")
+    def run(root):
+        generate_tree(root, b.profile, b.objects, b.sequences)
+        return len(b.objects)
+    return setup, run
+
+
+@benchmark("spreadsheet_import")
+def bench_spreadsheet_import(b: Benchmark):
+    sheet = b.workdir / "intake.xlsx"
+    write_intake_sheet(sheet, b.objects)
+    def setup():
+        return b.scratch("import")
+    def run(root):
+        plan = plan_import(read_rows(sheet), b.profile, root)
+        if plan.errors:
+            raise ValueError(f"The synthetic sheet has errors: {plan.errors[:5]}")
+        execute_import(plan, b.profile, root)
+        return len(b.objects)
+    return setup, run
+
+
+@benchmark("model_patch")
+def bench_model_patch(b: Benchmark):
+    config = b.profile.get_po_config('audiocassette')
+    def setup():
+        return [Model('audiocassette-sequence') for _ in range(len(b.objects))]
+    def run(models):
+        for i, m in enumerate(models):
+            with m.patching() as p:
+                p.patch(config.sequence_defaults, variables={'project_id': 'BENCH', 'physical_object_id': 'x', 'sequence_id': i})
+                p.patch({'system.project_id': 'BENCH', 'system.sequence_id': i})
+        return len(models)
+    return setup, run
+
+
+def _metadata_files(b: Benchmark) -> list[Path]:
+    """The physical object and sequence metadata files in a generated tree,
+       which is shared by the benchmarks that only read it"""
+    if not hasattr(b, '_tree'):
+        b._tree = b.scratch("tree")
+        generate_tree(b._tree, b.profile, b.objects, b.sequences)
+    return sorted(b._tree.glob("*/*/*.yaml"))
+
+
+@benchmark("yaml_read")
+def bench_yaml_read(b: Benchmark):
+    files = _metadata_files(b)
+    def setup():
+        return files
+    def run(files):
+        for f in files:
+            Model.read_file(f)
+        return len(files)
+    return setup, run
+
+
+@benchmark("yaml_write")
+def bench_yaml_write(b: Benchmark):
+    files = _metadata_files(b)
+    models = [(f, Model.read_file(f)) for f in files]
+    def setup():
+        return b.scratch("write")
+    def run(outdir):
+        for i, (f, m) in enumerate(models):
+            m.write_file(outdir / f"{i}-{f.name}")
+        return len(models)
+    return setup, run
+
+
+@benchmark("yaml_write_grouped")
+def bench_yaml_write_grouped(b: Benchmark):
+    files = _metadata_files(b)
+    models = [(f, Model.read_file(f)) for f in files]
+    def setup():
+        return b.scratch("write")
+    def run(outdir):
+        with write_session():
+            for i, (f, m) in enumerate(models):
+                m.write_file(outdir / f"{i}-{f.name}")
+        return len(models)
+    return setup, run
+
+
+def model_samples() -> dict[str, dict]:
+    """Raw data for each of the models, as it's read from a file"""
+    return {name: restore_unset(yamlio.load(Model(name).get_yaml_text())) for name in model_map}
+
+
+def _bench_model_load(b: Benchmark, trusted: bool):
+    samples = list(model_samples().items())
+    count = len(b.objects)
+    def setup():
+        return samples
+    def run(samples):
+        for name, data in samples:
+            for _ in range(count):
+                Model(name, data, trusted=trusted)
+        return count * len(samples)
+    return setup, run
+
+
+@benchmark("model_load")
+def bench_model_load(b: Benchmark):
+    return _bench_model_load(b, trusted=False)
+
+
+@benchmark("model_load_trusted")
+def bench_model_load_trusted(b: Benchmark):
+    return _bench_model_load(b, trusted=True)
+
+
+def load_speedup(count: int=200, repeat: int=3) -> dict:
+    """Time loading each model with validation, trusted (reading one field
+       with get()), and trusted but then validated by using the data.  The
+       times are the best per load, in ms."""
+    loads = {'validated': lambda name, data: Model(name, data).data.system.project_id,
+             'trusted': lambda name, data: Model(name, data, trusted=True).get('system.project_id'),
+             'trusted_then_used': lambda name, data: Model(name, data, trusted=True).data.system.project_id}
+    results = {}
+    for name, data in model_samples().items():
+        r = results[name] = {}
+        for label, load in loads.items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for _ in range(count):
+                    load(name, data)
+                times.append(time.perf_counter() - start)
+            r[f"{label}_ms"] = round(min(times) / count * 1000, 4)
+        r['speedup'] = round(r['validated_ms'] / r['trusted_ms'], 2) if r['trusted_ms'] else None
+    return results
+
+
+@benchmark("qc_evaluation")
+def bench_qc_evaluation(b: Benchmark):
+    qc = b.profile.get_po_config('audiocassette').uses['pres'].qc
+    datasets = [fake_probe_output(qc, fail=i % 10 == 0) for i in range(len(b.objects) * max(b.sequences, 1))]
+    def setup():
+        return datasets
+    def run(datasets):
+        compile_checks(qc).test_many(datasets)
+        return len(datasets)
+    return setup, run
+
+
+@benchmark("status_scan")
+def bench_status_scan(b: Benchmark):
+    _metadata_files(b)
+    def setup():
+        return b._tree
+    def run(root):
+        return sum(1 for _ in scan_status(root, b.profile))
+    return setup, run
+
+
+def run_benchmarks(bench: Benchmark, names: list[str]=None, repeat: int=3) -> dict:
+    """Run the benchmarks, returning the results"""
+    results = {}
+    for name in names or BENCHMARKS:
+        setup, run = BENCHMARKS[name](bench)
+        times = []
+        for _ in range(repeat):
+            state = setup()
+            start = time.perf_counter()
+            ops = run(state)
+            times.append(time.perf_counter() - start)
+        median = statistics.median(times)
+        results[name] = {'median_s': round(median, 6),
+                         'best_s': round(min(times), 6),
+                         'runs_s': [round(t, 6) for t in times],
+                         'ops': ops,
+                         'ops_per_s': round(ops / median, 1) if median else None}
+    return {'meta': {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'cpus': os.cpu_count(),
+                     'objects': len(bench.objects),
+                     'sequences': bench.sequences,
+                     'repeat': repeat},
+            'results': results}
+
+
+def compare(results: dict, baseline: dict, threshold: float=0.2) -> dict:
+    """Compare the median times with a baseline.  A benchmark has regressed
+       if it's slower than the baseline by more than the threshold (0.2 is
+       20%).  Benchmarks which are only in one of them are skipped."""
+    comparison = {}
+    for name, r in results['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base or not base['median_s']:
+            continue
+        ratio = r['median_s'] / base['median_s']
+        comparison[name] = {'baseline_s': base['median_s'],
+                            'current_s': r['median_s'],
+                            'ratio': round(ratio, 3),
+                            'regressed': ratio > 1 + threshold}
+    if baseline.get('meta', {}).get('objects') != results['meta']['objects']:
+        logging.warning("The baseline was run with a different number of objects")
+    return comparison
@@ -0,0 +1,87 @@
+"""Map file names back to the physical object, sequence, and use they belong to"""
+import re
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+from . import yamlio
+from .profiles import Profile
+from .utils import format_string_to_regex, IdMatcher
+
+
+class FileClass(NamedTuple):
+    """What a file name is, according to the profile"""
+    use: str
+    physical_types: tuple[str, ...]
+    physical_object_id: str
+    sequence_id: int
+    fields: dict
+
+
+class FileClassifier:
+    """Classify file names with one compiled regex which is the alternation
+       of every use pattern for every physical object type in a profile"""
+    def __init__(self, profile: Profile):
+        # several physical types can share a pattern (all of the audio types
+        # use the same file names), so each distinct pattern is only in the
+        # regex once.
+        patterns = {}
+        for physical_type in sorted(profile.physical_objects):
+            if physical_type == 'default' or physical_type.startswith('_'):
+                continue
+            config = profile.get_po_config(physical_type)
+            for use, usedata in config.uses.items():
+                patterns.setdefault(usedata.pattern, []).append((physical_type, use, config))
+
+        self._alternatives = {}
+        regexes = []
+        for i, (pattern, users) in enumerate(patterns.items()):
+            name = f"_{i}"
+            regex, field_types = format_string_to_regex(pattern, group_prefix=f"{name}_")
+            regexes.append(f"(?P<{name}>{regex})")
+            self._alternatives[name] = (users, f"{name}_", field_types)
+        self.regex = re.compile("^(?:" + "|".join(regexes) + ")$") if regexes else re.compile("(?!)")
+
+
+    def classify(self, filename: str) -> FileClass:
+        """Classify a file name (not a path), returning None if it doesn't
+           match any of the uses"""
+        m = self.regex.match(filename)
+        if not m:
+            return None
+        # the alternative's group is the last one to close
+        users, prefix, field_types = self._alternatives[m.lastgroup]
+        fields = {}
+        for field, ftype in field_types.items():
+            value = m.group(prefix + field)
+            fields[field] = IdMatcher.converters.get(ftype, str)(value)
+
+        physical_type, use, config = users[0]
+        try:
+            physical_object_id = config.id_pattern.format_map(fields)
+        except (KeyError, ValueError):
+            physical_object_id = None
+        return FileClass(use, tuple(x[0] for x in users), physical_object_id,
+                         fields.get('sequence_id'), fields)
+
+
+    def classify_many(self, filenames: Iterable[str]) -> Iterator[tuple[str, FileClass]]:
+        """Classify many file names, yielding (name, class or None)"""
+        classify = self.classify
+        for name in filenames:
+            yield name, classify(name)
+
+
+def resolve_physical_type(file: Path, fc: FileClass) -> str:
+    """Get the physical type of a classified file.  When several types share
+       the file name pattern, it comes from the physical object's metadata
+       in the file's directory."""
+    if len(fc.physical_types) == 1:
+        return fc.physical_types[0]
+    pofile = Path(file).parent / "physical_object.yaml"
+    if not pofile.exists():
+        return fc.physical_types[0]
+    with open(pofile) as f:
+        system = (yamlio.load(f) or {}).get('system', {})
+    physical_type = system.get('schema_name', '').removesuffix('-media')
+    if physical_type not in fc.physical_types:
+        raise ValueError(f"{Path(file).name} can't belong to a {physical_type} physical object")
+    return physical_type
@@ -0,0 +1,108 @@
+"""
+Talk to a running dwim service (see dwim.service)
+
+This only uses the standard library, so a command line tool can check for
+the service and forward its work before it imports anything heavy.
+
+The protocol is one JSON object per line over a Unix socket.  A request is
+{"op": name, "args": {...}} and the response is {"ok": true, "result": ...}
+or {"ok": false, "error": message, "type": exception name}.
+
+Only a socket owned by the user is trusted, so on a shared station another
+user can't stand in for the service.  Without $DWIM_SOCKET or a runtime
+directory, the socket goes in a private directory, /tmp/dwim-<uid>.
+"""
+import os
+import json
+import socket
+from pathlib import Path
+
+
+class ServiceUnavailable(ConnectionError):
+    """The service isn't running"""
+
+
+class ServiceError(RuntimeError):
+    """The service ran the request but it failed"""
+    def __init__(self, message: str, error_type: str=None):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+def default_socket() -> Path:
+    """The socket for this user's service:  $DWIM_SOCKET, or dwim.sock in
+       the runtime directory or else in /tmp/dwim-<uid>"""
+    if path := os.environ.get("DWIM_SOCKET"):
+        return Path(path)
+    if rundir := os.environ.get("XDG_RUNTIME_DIR"):
+        return Path(rundir, "dwim.sock")
+    return Path(f"/tmp/dwim-{os.getuid()}", "dwim.sock")
+
+
+def check_owner(path: Path):
+    """Raise PermissionError unless the path belongs to this user"""
+    if (uid := os.stat(path).st_uid) != os.getuid():
+        raise PermissionError(f"{path} belongs to user {uid}, not to this user")
+
+
+class ServiceClient:
+    """A connection to the service, which is opened on the first call"""
+    def __init__(self, socket_path: Path=None, timeout: float=None):
+        self.socket_path = Path(socket_path or default_socket())
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+
+
+    def connect(self):
+        """Connect to the service, raising ServiceUnavailable if it isn't running"""
+        if self._sock is not None:
+            return
+        if not self.socket_path.exists():
+            raise ServiceUnavailable(f"No dwim service at {self.socket_path}")
+        try:
+            check_owner(self.socket_path)
+        except OSError as e:
+            raise ServiceUnavailable(f"Not using the dwim service at {self.socket_path}: {e}")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(str(self.socket_path))
+        except OSError as e:
+            sock.close()
+            raise ServiceUnavailable(f"Cannot connect to the dwim service at {self.socket_path}: {e}")
+        self._sock = sock
+        self._file = sock.makefile("rwb")
+
+
+    def call(self, op: str, **args):
+        """Run an operation in the service and return its result"""
+        self.connect()
+        self._file.write(json.dumps({'op': op, 'args': args}).encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            self.close()
+            raise ServiceError(f"The dwim service closed the connection during {op}")
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise ServiceError(response.get('error', 'Unknown error'), response.get('type'))
+        return response.get('result')
+
+
+    def close(self):
+        """Close the connection"""
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+
+def forward(op: str, **args):
+    """Run an operation in the service if it's running, raising
+       ServiceUnavailable if it isn't so the caller can do the work itself"""
+    client = ServiceClient()
+    try:
+        return client.call(op, **args)
+    finally:
+        client.close()
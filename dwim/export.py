@@ -0,0 +1,202 @@
+"""
+Export the project metadata as flat JSON Lines
+
+Every physical object and every sequence becomes one JSON object on its
+own line.  The nested metadata is flattened into dotted paths (a key with
+a dot in it, like a file name under fixity, is quoted the way patch paths
+are:  fixity.'x.wav'.md5) and the project's metadata is repeated on every
+record under project.*.  Each record starts with the join keys:  the
+project's system fields, with the physical object and sequence IDs (and
+the profile and schema name) filled in from the record's own system
+fields.
+
+Projects are read in parallel, one per worker, and the records are handed
+to the writer in small batches through a bounded queue, so the memory used
+doesn't depend on the number of projects or objects.  Within a project the
+records are in structure order, with each physical object followed by its
+sequences, but the projects are interleaved.
+
+The files are read through each project's shadow cache (dwim.shadow), so
+an export after a few files have changed only parses those files again.
+"""
+import os
+import json
+import queue
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, TextIO
+from . import yamlio
+from .status import find_projects
+from .qc import QC_REPORT_SUFFIX
+from .shadow import ShadowCache
+
+
+# the records which are sent to the writer at a time
+BATCH_SIZE = 200
+
+JOIN_KEYS = ('project_id', 'physical_object_id', 'sequence_id', 'profile', 'schema_name')
+
+
+def flatten(data: dict, prefix: str='') -> dict:
+    """Flatten nested dicts into dotted paths.  Lists and empty dicts are
+       values."""
+    flat = {}
+    for key, value in data.items():
+        key = str(key)
+        if '.' in key:
+            key = f"'{key}'"
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def _load(filename: Path, cache: ShadowCache=None) -> dict:
+    if cache:
+        data = cache.read(filename)
+    else:
+        with open(filename) as f:
+            data = yamlio.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{filename} isn't a mapping")
+    return data
+
+
+def _record(record_type: str, file: str, data: dict, keys: dict, shared: dict) -> dict:
+    system = data.pop('system', None) or {}
+    record = {'record_type': record_type}
+    for key in JOIN_KEYS:
+        record[key] = keys[key] if keys.get(key) else system.get(key)
+    record['file'] = file
+    record.update(shared)
+    record.update(flatten(data))
+    return record
+
+
+def _physical_object_ids(project_dir: Path) -> list[str]:
+    """The physical objects in structure order, then any others in name
+       order"""
+    present = set()
+    with os.scandir(project_dir) as entries:
+        for entry in entries:
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, "physical_object.yaml")):
+                present.add(entry.name)
+    order = []
+    try:
+        order = _load(project_dir / "structure.yaml").get('object_structure') or []
+    except FileNotFoundError:
+        pass
+    except ValueError as e:
+        logging.warning(f"Ignoring the structure: {e}")
+    ids = [x for x in dict.fromkeys(order) if x in present]
+    return ids + sorted(present.difference(ids))
+
+
+def iter_records(project_dir: Path, counts: Counter=None, cache: ShadowCache=None) -> Iterator[dict]:
+    """Yield the flattened records for the physical objects and sequences of
+       a project, reading the files through the shadow cache if one is
+       given.  Files which can't be read are logged and counted as errors."""
+    project_dir = Path(project_dir)
+    counts = Counter() if counts is None else counts
+    project = _load(project_dir / "project.yaml")
+    # only the project ID is set in a project's system fields
+    system = project.pop('system', None) or {}
+    keys = {'project_id': system.get('project_id') or project_dir.name}
+    shared = flatten(project, "project.")
+    counts['projects'] += 1
+
+    for physical_id in _physical_object_ids(project_dir):
+        po_dir = project_dir / physical_id
+        try:
+            data = _load(po_dir / "physical_object.yaml", cache)
+        except Exception as e:
+            logging.warning(f"Cannot export {po_dir / 'physical_object.yaml'}: {e}")
+            counts['errors'] += 1
+            continue
+        yield _record('physical_object', f"{physical_id}/physical_object.yaml", data, keys, shared)
+        counts['physical_objects'] += 1
+
+        sequences = []
+        with os.scandir(po_dir) as entries:
+            names = [e.name for e in entries
+                     if e.name.endswith(".yaml") and not e.name.endswith(QC_REPORT_SUFFIX)
+                     and e.name != "physical_object.yaml" and e.is_file()]
+        for name in names:
+            try:
+                data = _load(po_dir / name, cache)
+            except Exception as e:
+                logging.warning(f"Cannot export {po_dir / name}: {e}")
+                counts['errors'] += 1
+                continue
+            system = data.get('system') or {}
+            if str(system.get('schema_name', '')).endswith('-sequence'):
+                sequences.append((system.get('sequence_id') or 0, name, data))
+        # only the sequences of one physical object are held at a time
+        sequences.sort(key=lambda s: (s[0], s[1]))
+        for _, name, data in sequences:
+            yield _record('sequence', f"{physical_id}/{name}", data, keys, shared)
+            counts['sequences'] += 1
+
+
+def export(directory: Path, out: TextIO, workers: int=None, batch_size: int=BATCH_SIZE,
+           shadow: bool=True) -> dict:
+    """Write the records for a project (or a directory of projects) to out
+       as JSON Lines, returning the counts of projects, physical objects,
+       sequences, and errors.  Unless shadow is off, the files are read
+       through the projects' shadow caches."""
+    projects = find_projects(directory)
+    workers = workers or min(8, (os.cpu_count() or 1) * 2)
+    batches = queue.Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    totals = Counter(projects=0, physical_objects=0, sequences=0, errors=0)
+
+    def put(item):
+        # give up if the writer has gone away
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work(project_dir: Path):
+        counts = Counter()
+        cache = ShadowCache.for_project(project_dir, required=False) if shadow else None
+        try:
+            lines = []
+            for record in iter_records(project_dir, counts, cache):
+                lines.append(json.dumps(record, default=str))
+                if len(lines) >= batch_size:
+                    if not put(('lines', lines)):
+                        return
+                    lines = []
+            if lines:
+                put(('lines', lines))
+        except Exception as e:
+            logging.warning(f"Cannot export project {project_dir}: {e}")
+            counts['errors'] += 1
+        finally:
+            if cache:
+                cache.close()
+            put(('done', counts))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for project_dir in projects:
+            pool.submit(work, project_dir)
+        remaining = len(projects)
+        try:
+            while remaining:
+                kind, value = batches.get()
+                if kind == 'lines':
+                    out.write("\n".join(value) + "\n")
+                else:
+                    totals.update(value)
+                    remaining -= 1
+        finally:
+            stop.set()
+    return dict(totals)
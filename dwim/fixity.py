@@ -0,0 +1,155 @@
+"""
+Fixity for the preservation files
+
+Every media file is read once and the data is fed to all of the hashers
+(MD5 and SHA-256 by default).  The file is read into a pair of large
+reusable buffers:  while the hashers work on one buffer (each in its own
+thread, since hashlib releases the GIL), the next block is read into the
+other, so a single large file goes as fast as the slowest hasher or the
+disk, whichever is slower.  Many files are hashed at once by a pool of
+workers.
+
+The digests are recorded in the sequence metadata of the file's sequence
+(under fixity, by file name) and can be verified against the files later.
+"""
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+from .profiles import Profile
+from .classifier import FileClassifier, resolve_physical_type
+from .model import Model
+from .models.common import Fixity
+from .utils import find_project_root
+from .trace import traced
+
+
+DEFAULT_ALGORITHMS = ('md5', 'sha256')
+
+# big enough that the per-block overhead doesn't matter, small enough that
+# a handful of workers don't use much memory
+BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class FileDigests(NamedTuple):
+    """The digests of a file and how long they took"""
+    file: Path
+    size: int
+    digests: dict[str, str]
+    seconds: float
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.size / 1_000_000 / self.seconds if self.seconds else 0.0
+
+
+@traced("fixity.hash_file")
+def hash_file(file: Path, algorithms: Iterable[str]=DEFAULT_ALGORITHMS,
+              buffer_size: int=BUFFER_SIZE) -> FileDigests:
+    """Compute all of the digests of a file in one pass"""
+    hashers = {a: hashlib.new(a) for a in algorithms}
+    start = time.perf_counter()
+    size = 0
+    with open(file, "rb", buffering=0) as f:
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        if len(hashers) == 1 or os.fstat(f.fileno()).st_size <= buffer_size:
+            # nothing to overlap
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while n := f.readinto(buffer):
+                for h in hashers.values():
+                    h.update(view[:n])
+                size += n
+        else:
+            with ThreadPoolExecutor(max_workers=len(hashers)) as pool:
+                buffers = [bytearray(buffer_size), bytearray(buffer_size)]
+                views = [memoryview(b) for b in buffers]
+                hashing = []
+                i = 0
+                while True:
+                    # read into one buffer while the other is hashed
+                    n = f.readinto(buffers[i])
+                    for future in hashing:
+                        future.result()
+                    if not n:
+                        break
+                    chunk = views[i][:n]
+                    hashing = [pool.submit(h.update, chunk) for h in hashers.values()]
+                    size += n
+                    i = 1 - i
+    return FileDigests(Path(file), size, {a: h.hexdigest() for a, h in hashers.items()},
+                       time.perf_counter() - start)
+
+
+def hash_many(files: Iterable[Path], algorithms: Iterable[str]=DEFAULT_ALGORITHMS,
+              workers: int=4, buffer_size: int=BUFFER_SIZE) -> Iterator[tuple[Path, FileDigests, Exception]]:
+    """Hash files concurrently, yielding (file, digests, error) as each one
+       finishes.  Exactly one of digests and error will be None."""
+    algorithms = tuple(algorithms)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(hash_file, f, algorithms, buffer_size): f for f in files}
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                yield file, future.result(), None
+            except Exception as e:
+                logging.debug(f"Cannot hash {file}: {e}")
+                yield file, None, e
+
+
+def metadata_files(file: Path, profile: Profile, classifier: FileClassifier) -> list[Path]:
+    """The sequence metadata files for the sequence that a media file is in"""
+    file = Path(file)
+    fc = classifier.classify(file.name)
+    if fc is None:
+        raise ValueError(f"{file.name} doesn't match any of the uses in profile {profile.name}")
+    config = profile.get_po_config(resolve_physical_type(file, fc))
+    return [file.with_name(u.pattern.format(**fc.fields) + ".yaml")
+            for u in config.uses.values() if u.has_metadata]
+
+
+def record_fixity(result: FileDigests, profile: Profile, classifier: FileClassifier) -> list[Path]:
+    """Record the digests of a file in its sequence's metadata, returning
+       the metadata files that were updated"""
+    fixity = {'size': result.size, **result.digests,
+              'computed': datetime.now().isoformat(timespec='seconds')}
+    updated = []
+    for mdfile in metadata_files(result.file, profile, classifier):
+        if not mdfile.exists():
+            logging.warning(f"Cannot record the fixity of {result.file.name}: {mdfile} doesn't exist")
+            continue
+        model = Model.read_file(mdfile)
+        # set directly rather than through a json path, which can't have
+        # just any file name in it
+        model.data.fixity[result.file.name] = Fixity(**fixity)
+        root = find_project_root(mdfile.parent)
+        model.write_file(mdfile, schemadir=root / "schemas" if root else None)
+        updated.append(mdfile)
+    return updated
+
+
+def verify_fixity(result: FileDigests, profile: Profile, classifier: FileClassifier) -> dict:
+    """Compare the digests of a file with the ones in its sequence metadata.
+       The status is ok, mismatch, or unrecorded."""
+    report = {'file': str(result.file), 'status': 'unrecorded', 'mismatches': []}
+    for mdfile in metadata_files(result.file, profile, classifier):
+        if not mdfile.exists():
+            continue
+        # the metadata is only read, so it isn't validated
+        recorded = Model.read_file(mdfile, trusted=True).get('fixity').get(result.file.name)
+        if recorded is None:
+            continue
+        if recorded['size'] != result.size:
+            report['mismatches'].append(f"{mdfile.name}: size is {result.size} but {recorded['size']} was recorded")
+        for algorithm, digest in result.digests.items():
+            if recorded.get(algorithm) and recorded[algorithm] != digest:
+                report['mismatches'].append(f"{mdfile.name}: {algorithm} is {digest} but {recorded[algorithm]} was recorded")
+        report['status'] = 'mismatch' if report['mismatches'] else 'ok'
+    return report
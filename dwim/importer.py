@@ -0,0 +1,226 @@
+"""
+Import projects and physical objects from an intake spreadsheet (or CSV)
+
+The import happens in three steps:
+* the rows are read once and normalized into dicts keyed by the normalized
+  column title
+* the whole sheet is planned and validated, collecting every problem rather
+  than stopping at the first one
+* if there were no problems, the projects and physical objects are created
+"""
+import csv
+import logging
+import getpass
+import pwd
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterator
+from pydantic import BaseModel, Field
+from .profiles import Profile
+from .project import Project
+from .model import write_session
+from .index import ProjectIndex, get_barcode
+
+
+# spreadsheet column -> project metadata path
+PROJECT_COLUMNS = (('owner', 'project_information.contacts[0].name'),
+                   ('email', 'project_information.contacts[0].email'),
+                   ('callnumber', 'descriptive_metadata.identifiers.call_number'),
+                   ('catkey', 'descriptive_metadata.identifiers.iucat_catkey'),
+                   ('barcode', 'descriptive_metadata.identifiers.iucat_barcode'),
+                   ('localscope', 'descriptive_metadata.identifiers.other_identifiers[0].scope'),
+                   ('localid', 'descriptive_metadata.identifiers.other_identifiers[0].identifier'),
+                   ('title', 'descriptive_metadata.title'))
+
+# spreadsheet column -> physical object metadata path
+PHYSICAL_COLUMNS = (('comments', 'physical_details.comments'),)
+
+# project fields which are inherited from the previous project if blank
+INHERITED_COLUMNS = ('owner', 'email')
+
+REQUIRED_COLUMNS = ('project', 'format')
+
+
+class PlannedProject(BaseModel):
+    """A project and the physical objects to create in it"""
+    name: str
+    exists: bool = False
+    defaults: dict[str, Any] = Field(default_factory=dict)
+    physical_objects: list[tuple[str, str, dict[str, Any]]] = Field(default_factory=list)
+
+
+class ImportPlan(BaseModel):
+    """Everything that an import will create, and the reasons it can't"""
+    projects: dict[str, PlannedProject] = Field(default_factory=dict)
+    errors: list[str] = Field(default_factory=list)
+
+
+def normalize_title(text: str):
+    """Convert a spreadsheet column name to where it maps in the grand scheme of things"""
+    return text.strip().lower().translate({ord(x): None for x in " -_.\"'"})
+
+
+def read_rows(filename: Path) -> Iterator[tuple[str, int, dict[str, str]]]:
+    """Read the rows of a spreadsheet or CSV file, yielding (sheet name,
+       row number, row) where row maps the normalized column titles to the
+       cell values as strings"""
+    filename = Path(filename)
+    if filename.suffix.lower() == '.csv':
+        with open(filename, newline='') as f:
+            yield from _normalize_rows(filename.name, csv.reader(f))
+    else:
+        # imported here so CSV imports don't need openpyxl
+        from openpyxl.reader.excel import load_workbook
+        workbook = load_workbook(filename, read_only=True, data_only=True)
+        try:
+            for worksheet in workbook.worksheets:
+                yield from _normalize_rows(worksheet.title, worksheet.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+
+
+def _normalize_rows(source: str, rows) -> Iterator[tuple[str, int, dict[str, str]]]:
+    """Map each row's values to the normalized titles in the first row"""
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    keys = {c: normalize_title(str(x)) for c, x in enumerate(header) if x is not None and str(x).strip()}
+    for r, values in enumerate(rows, start=2):
+        row = {name: '' for name in keys.values()}
+        for c, name in keys.items():
+            if c < len(values) and values[c] is not None:
+                row[name] = str(values[c])
+        yield source, r, row
+
+
+def plan_import(rows, profile: Profile, rootdir: Path) -> ImportPlan:
+    """Validate all of the rows and work out what needs to be created"""
+    plan = ImportPlan()
+    index = ProjectIndex.for_root(rootdir)
+    candidates = []
+    seen_ids = {}
+    seen_barcodes = {}
+    project = None
+    last_project = {}
+    last_source = None
+    for source, r, row in rows:
+        where = f"{source} row {r}"
+        if source != last_source:
+            # each sheet starts fresh
+            last_source = source
+            project = None
+            missing = [x for x in REQUIRED_COLUMNS if x not in row]
+            if missing:
+                plan.errors.append(f"{source}: missing required columns {missing}")
+        if any(row.get(x) is None for x in REQUIRED_COLUMNS):
+            continue
+
+        if row['project'] != '':
+            # new project.
+            for f in INHERITED_COLUMNS:
+                if row.get(f, '') == '':
+                    row[f] = last_project.get(f, '')
+            last_project = row
+
+            name = row['project']
+            if name in plan.projects:
+                plan.errors.append(f"{where}: project {name} appears more than once")
+                project = None
+                continue
+            try:
+                Project.validate_name(name)
+            except ValueError as e:
+                plan.errors.append(f"{where}: {e}")
+                project = None
+                continue
+
+            project = PlannedProject(name=name, exists=(rootdir / name).exists())
+            plan.projects[name] = project
+            if project.exists:
+                logging.info(f"Project {name} already exists, will only add missing physical objects")
+            else:
+                for col, path in PROJECT_COLUMNS:
+                    if row.get(col, '') != '':
+                        project.defaults[path] = row[col]
+                # inject our user.
+                project.defaults["project_information.creator"] = getpass.getuser()
+                project.defaults["project_information.creator_name"] = pwd.getpwnam(getpass.getuser()).pw_gecos
+                project.defaults["project_information.create_date"] = datetime.strftime(datetime.now(), "%Y-%m-%d")
+
+        if project and row['format']:
+            # create a physical object for this row.
+            defaults = {}
+            if row['project'] != '':
+                # this is a single-media object, set the title to 'SAME'
+                defaults['title'] = "SAME"
+            else:
+                defaults['title'] = row.get('title', '')
+            for col, path in PHYSICAL_COLUMNS:
+                if row.get(col, '') != '':
+                    defaults[path] = row[col]
+
+            try:
+                po_config = profile.get_po_config(row['format'])
+            except (KeyError, ValueError) as e:
+                plan.errors.append(f"{where}: format {row['format']}: {e}")
+                continue
+            try:
+                phy_name = po_config.id_pattern.format_map(row)
+            except (KeyError, ValueError) as e:
+                plan.errors.append(f"{where}: cannot build the physical object id from '{po_config.id_pattern}': {e}")
+                continue
+            candidates.append((where, project, phy_name, row['format'], po_config, defaults))
+
+    # validate the whole column of IDs for each format in one go
+    by_format = {}
+    for i, candidate in enumerate(candidates):
+        by_format.setdefault(candidate[3], []).append(i)
+    checks = [None] * len(candidates)
+    for rows_for_format in by_format.values():
+        matcher = candidates[rows_for_format[0]][4].id_matcher
+        results = matcher.check_many([candidates[i][2] for i in rows_for_format])
+        for i, result in zip(rows_for_format, results):
+            checks[i] = result
+
+    for (where, project, phy_name, phy_type, po_config, defaults), (id_fields, errors) in zip(candidates, checks):
+        if errors:
+            plan.errors.extend(f"{where}: {e}" for e in errors)
+            continue
+        barcode = get_barcode(po_config, id_fields)
+
+        if phy_name in seen_ids:
+            plan.errors.append(f"{where}: physical object {phy_name} is also on {seen_ids[phy_name]}")
+            continue
+        seen_ids[phy_name] = where
+
+        if project.exists and (rootdir / project.name / phy_name).exists():
+            logging.debug(f"{where}: physical object {phy_name} already exists in {project.name}")
+            continue
+
+        if barcode is not None:
+            if barcode in seen_barcodes:
+                plan.errors.append(f"{where}: barcode {barcode} is also on {seen_barcodes[barcode]}")
+                continue
+            seen_barcodes[barcode] = where
+            if (other := index.find_barcode(barcode)) is not None:
+                plan.errors.append(f"{where}: barcode {barcode} is already used by {other['physical_object_id']} in project {other['project_id']}")
+                continue
+        project.physical_objects.append((phy_name, phy_type, defaults))
+
+    index.close()
+    return plan
+
+
+def execute_import(plan: ImportPlan, profile: Profile, rootdir: Path):
+    """Create the projects and physical objects in a (valid) plan"""
+    if plan.errors:
+        raise ValueError("Cannot import a plan which has errors")
+    index = ProjectIndex.for_root(rootdir)
+    for planned in plan.projects.values():
+        project = Project(rootdir, planned.name, create=not planned.exists,
+                          defaults=planned.defaults, index=index)
+        # the objects' files are written together when the project is done
+        with write_session():
+            project.add_physical_objects(profile, planned.physical_objects)
+    index.close()
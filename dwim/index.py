@@ -0,0 +1,198 @@
+"""Index of the projects, physical objects, and sequences under a root directory"""
+import sqlite3
+import logging
+import os
+from pathlib import Path
+from . import yamlio
+from .profiles import Profile, PhysicalConfig, load_profile
+
+
+INDEX_FILE = ".dwim_index.sqlite"
+
+
+class BarcodeInUseError(ValueError):
+    """The barcode is already used by another physical object"""
+
+
+class ProjectIndex:
+    """An SQLite index of everything under a project root directory.  It is
+       kept up to date by Project as things are added, and can be rebuilt
+       from the files at any time."""
+    def __init__(self, dbfile: Path):
+        self.dbfile = Path(dbfile)
+        self._db = sqlite3.connect(self.dbfile)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS projects (
+                    project_id TEXT PRIMARY KEY);
+                CREATE TABLE IF NOT EXISTS physical_objects (
+                    project_id TEXT NOT NULL,
+                    physical_object_id TEXT NOT NULL,
+                    media_type TEXT NOT NULL,
+                    profile TEXT,
+                    barcode TEXT,
+                    PRIMARY KEY (project_id, physical_object_id));
+                CREATE INDEX IF NOT EXISTS physical_object_id ON physical_objects (physical_object_id);
+                CREATE INDEX IF NOT EXISTS media_type ON physical_objects (media_type);
+                CREATE UNIQUE INDEX IF NOT EXISTS barcode ON physical_objects (barcode) WHERE barcode IS NOT NULL;
+                CREATE TABLE IF NOT EXISTS sequences (
+                    project_id TEXT NOT NULL,
+                    physical_object_id TEXT NOT NULL,
+                    sequence_id INTEGER NOT NULL,
+                    filename TEXT NOT NULL,
+                    PRIMARY KEY (project_id, physical_object_id, filename));
+                CREATE INDEX IF NOT EXISTS sequence_po ON sequences (physical_object_id, sequence_id);
+            """)
+
+
+    @staticmethod
+    def for_root(rootdir: Path, profiles: dict[str, Profile]=None) -> "ProjectIndex":
+        """Open the index for a project root directory.  If there isn't one
+           yet, it's built from whatever is already under the root, so the
+           barcodes of the existing physical objects are checked too."""
+        dbfile = Path(rootdir) / INDEX_FILE
+        if dbfile.exists():
+            return ProjectIndex(dbfile)
+        logging.info(f"Building the index for {rootdir}")
+        index = ProjectIndex(dbfile)
+        try:
+            index.rebuild(rootdir, profiles)
+        except BaseException:
+            # don't leave a partial index which would be trusted next time
+            index.close()
+            dbfile.unlink(missing_ok=True)
+            raise
+        return index
+
+
+    def close(self):
+        """Close the database"""
+        self._db.close()
+
+
+    def add_project(self, project_id: str):
+        """Record a project"""
+        with self._db:
+            self._db.execute("INSERT OR IGNORE INTO projects (project_id) VALUES (?)", (project_id,))
+
+
+    def check_barcodes(self, barcodes: list[str]):
+        """Raise BarcodeInUseError if any of the barcodes are already used"""
+        for barcode in barcodes:
+            if (row := self.find_barcode(barcode)) is not None:
+                raise BarcodeInUseError(f"Barcode {barcode} is already used by {row['physical_object_id']} in project {row['project_id']}")
+
+
+    def find_barcode(self, barcode: str) -> dict:
+        """Get the physical object with the given barcode, or None"""
+        row = self._db.execute("SELECT * FROM physical_objects WHERE barcode=?", (barcode,)).fetchone()
+        return None if row is None else dict(row)
+
+
+    def add_physical_object(self, project_id: str, physical_object_id: str, media_type: str,
+                            profile: str=None, barcode: str=None):
+        """Record a physical object.  Raises BarcodeInUseError if another
+           physical object has the barcode."""
+        try:
+            with self._db:
+                self._db.execute("INSERT OR IGNORE INTO projects (project_id) VALUES (?)", (project_id,))
+                # not INSERT OR REPLACE, which would delete the other object
+                # to resolve a clash on the barcode
+                self._db.execute("""INSERT INTO physical_objects (project_id, physical_object_id, media_type, profile, barcode)
+                                    VALUES (?, ?, ?, ?, ?)
+                                    ON CONFLICT (project_id, physical_object_id) DO UPDATE SET
+                                        media_type=excluded.media_type, profile=excluded.profile, barcode=excluded.barcode""",
+                                 (project_id, physical_object_id, media_type, profile, barcode))
+        except sqlite3.IntegrityError:
+            raise BarcodeInUseError(f"Barcode {barcode} is already in use")
+
+
+    def add_sequence(self, project_id: str, physical_object_id: str, sequence_id: int, filename: str):
+        """Record a sequence metadata file"""
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO sequences (project_id, physical_object_id, sequence_id, filename) VALUES (?, ?, ?, ?)",
+                             (project_id, physical_object_id, sequence_id, filename))
+
+
+    def physical_objects(self, project_id: str=None, physical_object_id: str=None,
+                         media_type: str=None, barcode: str=None) -> list[dict]:
+        """Find the physical objects which match all of the given values"""
+        return self._select("SELECT * FROM physical_objects", {'project_id': project_id,
+                                                                'physical_object_id': physical_object_id,
+                                                                'media_type': media_type,
+                                                                'barcode': barcode},
+                            "ORDER BY project_id, physical_object_id")
+
+
+    def sequences(self, project_id: str=None, physical_object_id: str=None, sequence_id: int=None,
+                  media_type: str=None, barcode: str=None) -> list[dict]:
+        """Find the sequences which match all of the given values"""
+        return self._select("SELECT s.*, p.media_type, p.barcode FROM sequences s JOIN physical_objects p USING (project_id, physical_object_id)",
+                            {'s.project_id': project_id,
+                             's.physical_object_id': physical_object_id,
+                             's.sequence_id': sequence_id,
+                             'p.media_type': media_type,
+                             'p.barcode': barcode},
+                            "ORDER BY s.project_id, s.physical_object_id, s.sequence_id, s.filename")
+
+
+    def _select(self, query: str, filters: dict, order: str) -> list[dict]:
+        where = [(k, v) for k, v in filters.items() if v is not None]
+        if where:
+            query += " WHERE " + " AND ".join(f"{k}=?" for k, _ in where)
+        return [dict(r) for r in self._db.execute(f"{query} {order}", [v for _, v in where])]
+
+
+    def rebuild(self, rootdir: Path, profiles: dict[str, Profile]=None):
+        """Throw away the index and rescan everything under the root.  Any
+           profiles not given by name are loaded as needed."""
+        profiles = dict(profiles or {})
+        with self._db:
+            self._db.execute("DELETE FROM sequences")
+            self._db.execute("DELETE FROM physical_objects")
+            self._db.execute("DELETE FROM projects")
+
+        for project in sorted(os.scandir(rootdir), key=lambda e: e.name):
+            if not project.is_dir() or not os.path.exists(os.path.join(project.path, "project.yaml")):
+                continue
+            self.add_project(project.name)
+            for po in sorted(os.scandir(project.path), key=lambda e: e.name):
+                pofile = os.path.join(po.path, "physical_object.yaml")
+                if not po.is_dir() or not os.path.exists(pofile):
+                    continue
+                with open(pofile) as f:
+                    system = yamlio.load(f).get('system', {})
+                media_type = system.get('schema_name', '').removesuffix('-media')
+                profile = system.get('profile') or None
+                barcode = None
+                if profile:
+                    if profile not in profiles:
+                        profiles[profile] = load_profile(profile)
+                    try:
+                        config = profiles[profile].get_po_config(media_type)
+                        barcode = get_barcode(config, config.id_matcher.match(po.name))
+                    except (KeyError, ValueError) as e:
+                        logging.warning(f"Cannot get the barcode for {po.path}: {e}")
+                try:
+                    self.add_physical_object(project.name, po.name, media_type, profile, barcode)
+                except BarcodeInUseError:
+                    logging.warning(f"{po.path} has barcode {barcode} which is already used by {self.find_barcode(barcode)}")
+                    self.add_physical_object(project.name, po.name, media_type, profile, None)
+
+                for entry in os.scandir(po.path):
+                    if entry.name == "physical_object.yaml" or not entry.name.endswith(".yaml"):
+                        continue
+                    with open(entry.path) as f:
+                        system = (yamlio.load(f) or {}).get('system', {})
+                    if system.get('schema_name', '').endswith('-sequence'):
+                        self.add_sequence(project.name, po.name, system.get('sequence_id', 0), entry.name)
+
+
+def get_barcode(config: PhysicalConfig, id_fields: dict) -> str:
+    """Get the Luhn-validated barcode from the parsed fields of a physical
+       object ID, or None if the ID doesn't contain one"""
+    for field, validator in config.id_validators.items():
+        if validator and validator[0] == 'luhn' and field in id_fields:
+            return str(id_fields[field])
+    return None
@@ -1,104 +1,245 @@
 from pathlib import Path
 import yaml
 import sys
-import jsonpath_ng 
 import logging
 import json
-from dwim.models.project import Project
-from dwim.models.media.audiocassette import Audiocassette_Media, AudioCassette_Sequence
-from dwim.models.media.open_reel_audio import OpenReelAudio_Media, OpenReelAudio_Sequence
-from dwim.models.media.betacam import Betacam_Media, Betacam_Sequence
-from dwim.models.media.umatic import Umatic_Media, Umatic_Sequence
-from dwim.models.structure import Structure
+import threading
+import os
+import copy
+import hashlib
+import importlib
+import time
+import statistics
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+from functools import lru_cache
+from contextlib import contextmanager
+from typing import Callable
+from pydantic import BaseModel
 from dwim.models import UNSET
+from dwim import yamlio
+from dwim.yamlio import MySafeDumper
+from dwim.shadow import ShadowCache
+from dwim.trace import span, traced
 
-# do some YAML magic to handle sets...
-class MySafeDumper(yaml.SafeDumper):
-    # Indent arrays per https://stackoverflow.com/questions/25108581/python-yaml-dump-bad-indentation
-    def increase_indent(self, flow=False, indentless=False):
-        return super(MySafeDumper, self).increase_indent(flow, False)
 
-def represent_set(dumper, data):
-    return dumper.represent_sequence(yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, data, flow_style=True)
-    #return dumper.represent_sequence("set", data, flow_style=True)
+class ModelRegistry(Mapping):
+    """The pydantic models by schema name.  A model's module isn't imported
+       until the model is used, so a tool only pays for the models it needs."""
+    def __init__(self, locations: dict[str, str]):
+        self._locations = locations
+        self._models = {}
 
-def represent_list(dumper, data):
-    # we flow if there are only scalars
-    flow = all([type(x) in (str, bool, int, float) for x in data])
-    return dumper.represent_sequence(yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, data, flow_style=flow)
 
+    def __getitem__(self, name: str) -> type[BaseModel]:
+        model = self._models.get(name)
+        if model is None:
+            module, cls = self._locations[name].split(':')
+            model = self._models[name] = getattr(importlib.import_module(module), cls)
+        return model
 
-MySafeDumper.add_representer(set, represent_set )
-#MySafeDumper.add_representer(list, represent_list)
-                            
 
+    def __contains__(self, name) -> bool:
+        return name in self._locations
 
-model_map = {
-    'project': Project,
-    'audiocassette-media': Audiocassette_Media,
-    'audiocassette-sequence': AudioCassette_Sequence,
-    'open_reel_audio-media': OpenReelAudio_Media,
-    'open_reel_audio-sequence': OpenReelAudio_Sequence,
-    'betacam-media': Betacam_Media,
-    'betacam-sequence': Betacam_Sequence,
-    'umatic-media': Umatic_Media,
-    'umatic-sequence': Umatic_Sequence,
-    'structure': Structure,
-}
+
+    def __iter__(self):
+        return iter(self._locations)
+
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+
+model_map = ModelRegistry({
+    'project': 'dwim.models.project:Project',
+    'audiocassette-media': 'dwim.models.media.audiocassette:Audiocassette_Media',
+    'audiocassette-sequence': 'dwim.models.media.audiocassette:AudioCassette_Sequence',
+    'open_reel_audio-media': 'dwim.models.media.open_reel_audio:OpenReelAudio_Media',
+    'open_reel_audio-sequence': 'dwim.models.media.open_reel_audio:OpenReelAudio_Sequence',
+    'betacam-media': 'dwim.models.media.betacam:Betacam_Media',
+    'betacam-sequence': 'dwim.models.media.betacam:Betacam_Sequence',
+    'umatic-media': 'dwim.models.media.umatic:Umatic_Media',
+    'umatic-sequence': 'dwim.models.media.umatic:Umatic_Sequence',
+    'structure': 'dwim.models.structure:Structure',
+})
+
+# the default place for the generated schemas
+schema_dir = Path(__file__).parent.parent / "schemas"
+
+# where the schemas are stored, relative to the directory holding the projects
+SCHEMA_STORE = ".schemas"
+
+
+@lru_cache(maxsize=None)
+def get_json_schema(name: str) -> tuple[str, str]:
+    """Get the JSON schema text for a model and the sha256 of that text.
+       It's only generated once per process."""
+    with span("model_json_schema"):
+        text = json.dumps(model_map[name].model_json_schema(), indent=4, sort_keys=False)
+    return text, hashlib.sha256(text.encode()).hexdigest()
+
+
+_linked_schemas = set()
+
+def link_schema(schemadir: Path, name: str) -> str:
+    """Make sure that a project's schema directory has the current schema for
+       the model and return its file name.  The schema is stored once, named
+       by its hash, in the store shared by all of the projects next to this
+       one, and the project's schema directory links to it.  After the first
+       call for a directory and model, this doesn't touch the disk at all."""
+    text, digest = get_json_schema(name)
+    filename = f"{name}-{digest[:16]}.json"
+    key = (str(schemadir), filename)
+    if key in _linked_schemas:
+        return filename
+
+    store = Path(os.path.abspath(schemadir)).parent.parent / SCHEMA_STORE
+    stored = store / filename
+    if not stored.exists():
+        store.mkdir(exist_ok=True)
+        tmpfile = store / f".{filename}.{os.getpid()}"
+        tmpfile.write_text(text)
+        os.replace(tmpfile, stored)
+    try:
+        os.symlink(os.path.relpath(stored, schemadir), Path(schemadir, filename))
+    except FileExistsError:
+        pass
+    _linked_schemas.add(key)
+    return filename
+
+
+@lru_cache(maxsize=None)
+def parse_path(path: str) -> "jsonpath_ng.JSONPath":
+    """Parse a json path, caching the result for the life of the process"""
+    # imported here since it's slow to load and only needed for patching
+    import jsonpath_ng
+    return jsonpath_ng.parse(path)
+
+
+_MISSING = object()
 
 class Model:
-    """Data Models"""
-    def __init__(self, name, init_data: dict = None):
+    """Data Models.  A trusted model (one read from a file that dwim wrote,
+       for reporting) keeps the data as it was read, and it's only validated
+       when the data is used, patched, or written, or validate() is called.
+       Until then get() reads fields from the raw data."""
+    def __init__(self, name, init_data: dict = None, trusted: bool=False):
         if name not in model_map:
             raise KeyError(f"Model {name} is unknown")
         self.name = name
         self.model = model_map[name]        
-        self.initialize(init_data)
+        self.initialize(init_data, trusted)
         
 
-    def initialize(self, data=None):
+    @traced("Model.initialize")
+    def initialize(self, data=None, trusted: bool=False):
         """Create an empty model that uses the defaults"""
-        if data is None:
-            self.data = self.model()
-        else:            
+        # set the schema name before validating so it only happens once.
+        data = dict(data) if data else {}
+        system = data.get('system')
+        if isinstance(system, BaseModel):
+            system = system.model_dump()
+        if system is None:
+            system = {}
+        if isinstance(system, dict):
+            data['system'] = {**system, 'schema_name': self.name}
+        if trusted:
+            self._raw = data
+            self._data = None
+        else:
             self.data = self.model(**data)
-        self.patch({'system.schema_name': self.name})
 
 
-    def patch(self, defaults: dict, create: bool=True, variables: dict = None) -> dict:
-        """Apply patches to the data"""                
-        data = self.data.model_dump()
-        #print("Before patch:", data)
-        for k, v in defaults.items():
-            if variables:
-                # try to do variable substitution in the value
-                v = str(v).format_map(variables)    
-            jpath = jsonpath_ng.parse(k)            
-            if create:
-                jpath.update_or_create(data, v)        
+    @property
+    def data(self) -> BaseModel:
+        """The validated data"""
+        if self._data is None:
+            self.validate()
+        return self._data
+
+
+    @data.setter
+    def data(self, value: BaseModel):
+        self._data = value
+        self._raw = None
+
+
+    @property
+    def validated(self) -> bool:
+        return self._data is not None
+
+
+    def get(self, path: str, default=None):
+        """Get a field by its dotted path, without validating a trusted model.
+           The value is plain data, as it's read from the file (with sets
+           as lists), whether the model has been validated or not.  A field
+           which isn't in a trusted model's data has the model's default,
+           and anything else which isn't there is the given default.  A
+           trusted model's values are as they were read, since they haven't
+           been validated."""
+        if self._data is not None:
+            value = self._data
+            for key in path.split('.'):
+                if isinstance(value, BaseModel):
+                    value = getattr(value, key, _MISSING)
+                elif isinstance(value, dict):
+                    value = value.get(key, _MISSING)
+                else:
+                    return default
+                if value is _MISSING:
+                    return default
+            return _plain(value)
+
+        value, model = self._raw, self.model
+        for key in path.split('.'):
+            field = model.model_fields.get(key) if model else None
+            if not isinstance(value, dict):
+                return default
+            if key in value:
+                value = value[key]
+            elif field is not None and not field.is_required():
+                value = _plain(field.get_default(call_default_factory=True))
             else:
-                if not jpath.find(data):
-                    raise KeyError(f"Setting default value for {k} but it wasn't found in the tree")                    
-                jpath.update(data, v)
-        #print("After patch:", data)
-        self.data = self.model(**data)
+                return default
+            model = field.annotation if field and isinstance(field.annotation, type) and issubclass(field.annotation, BaseModel) else None
+        return value
+
+
+    def patch(self, defaults: dict, create: bool=True, variables: dict = None) -> dict:
+        """Apply patches to the data"""
+        with self.patching() as session:
+            session.patch(defaults, create, variables)
 
 
+    @contextmanager
+    def patching(self):
+        """Apply any number of patches to the data, validating once when the
+           block exits:
+
+               with model.patching() as p:
+                   p.patch(config.sequence_defaults, variables=...)
+                   p.patch({'system.sequence_id': seqno})
+        """
+        session = PatchSession(self)
+        yield session
+        session.commit()
+
+
+    @traced("Model.validate")
     def validate(self):
-        """Validate data against this schema"""
-        self.model(self.data)
+        """Validate the data against this schema, if it was trusted.  Raises
+           pydantic's ValidationError if it isn't valid."""
+        if self._data is None:
+            self.data = self.model(**self._raw)
 
 
     def get_yaml_text(self, schema: Path=None, clean=True):
         """Get the yaml file text for the data given."""
         # prepend the schema information for the yaml language server        
         txt = f"# yaml-language-server: $schema={schema}\n" if schema else ""
-        txt += yaml.dump(self.data.model_dump(), 
-                         Dumper=MySafeDumper,
-                         sort_keys=False, 
-                         default_flow_style=False, 
-                         allow_unicode=True, 
-                         indent=4, width=80)
+        txt += yamlio.dump(self.data.model_dump())
 
         #txt += yaml.safe_dump(self.data.model_dump(), 
         #                      sort_keys=False, 
@@ -118,35 +259,340 @@ class Model:
             outfile = outfile / f"{self.name}.json"        
         if rewrite or not outfile.exists():
             with open(outfile, "w") as f:
-                json.dump(self.model.model_json_schema(), f, indent=4, sort_keys=False)
+                f.write(get_json_schema(self.name)[0])
 
 
+    @traced("Model.write_file")
     def write_file(self, filename: Path, schemadir: Path=None, clean=True):
         """Write out the file"""
         schema = None
         if schemadir:
-            schema = schemadir.relative_to(filename.parent, walk_up=True) / f"{self.name}.json"
-            self.write_json_schema(schemadir, rewrite=False)
+            schema = Path(os.path.relpath(schemadir, filename.parent), link_schema(schemadir, self.name))
         text = self.get_yaml_text(schema, clean)
+        if (session := _write_session.get()) is not None:
+            session.add(filename, text)
+            return
         with open(filename, "w") as f:
             f.write(text)
 
 
     @staticmethod
-    def read_file(filename: Path, empty_ok: bool=False, model_name: str=None) -> "Model":
-        """Read a yaml file and return a model for it"""
-        if not filename.exists():        
+    @traced("Model.read_file")
+    def read_file(filename: Path, empty_ok: bool=False, model_name: str=None,
+                  cache: "ShadowCache"=None, trusted: bool=False) -> "Model":
+        """Read a yaml file and return a model for it.  If a shadow cache is
+           given, the parsed data comes from there when it's current.  A file
+           waiting to be written by the write session is read as written.  If
+           trusted, the data isn't validated until it has to be."""
+        pending = _pending_text(filename)
+        if pending is None and not filename.exists():        
             if empty_ok:
                 return Model(model_name)
             raise FileNotFoundError(f"File {filename} doesn't exist")
         
-        with open(filename) as f:
-            raw_data = yaml.safe_load(f)
+        if pending is not None:
+            raw_data = _parse_yaml(pending)
+        else:
+            raw_data = _read_yaml(filename, cache)
 
-        if 'system' in raw_data:
+        if isinstance(raw_data, dict) and 'system' in raw_data:
             model_name = raw_data['system'].get("schema_name", None)
             if model_name and model_name in model_map:
-                return Model(model_name, raw_data)
+                return Model(model_name, raw_data, trusted=trusted)
         
         raise NotImplementedError("The data file doesn't seem to be valid model")
 
+
+def _plain(value):
+    """Validated data as plain data, the way it's read from a file:  what
+       model_dump gives, but with sets as lists"""
+    if isinstance(value, BaseModel):
+        value = value.model_dump()
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, set, frozenset)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def _read_yaml(filename: Path, cache: ShadowCache=None):
+    """Read a model file's raw data, through the shadow cache if there is one"""
+    if cache:
+        data = cache.read(filename)
+        return restore_unset(data) if isinstance(data, dict) else data
+    with open(filename) as f:
+        return _parse_yaml(f)
+
+
+def _parse_yaml(stream):
+    """Parse a model file's raw data from a stream (or string)"""
+    data = yamlio.load(stream)
+    return restore_unset(data) if isinstance(data, dict) else data
+
+
+def restore_unset(data):
+    """Undo the cleaning done by get_yaml_text:  UNSET values were written as
+       empty values, so they read back as None"""
+    if isinstance(data, dict):
+        return {k: restore_unset(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [restore_unset(x) for x in data]
+    return UNSET if data is None else data
+
+
+class LazyModel:
+    """A handle for a model file which isn't read until its data is used.
+       Attributes which aren't on the handle come from the model's data."""
+    def __init__(self, filename: Path, cache: ShadowCache=None, trusted: bool=False, **info):
+        self.filename = filename
+        self.__dict__.update(info)
+        self._cache = cache
+        self._trusted = trusted
+        self._model = None
+
+
+    @property
+    def model(self) -> Model:
+        """The model, read from the file the first time it's needed"""
+        if self._model is None:
+            self._model = Model.read_file(self.filename, cache=self._cache, trusted=self._trusted)
+        return self._model
+
+
+    def get(self, path: str, default=None):
+        """Get a field by its dotted path (without validating a trusted model)"""
+        return self.model.get(path, default)
+
+
+    @property
+    def data(self):
+        return self.model.data
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.model.data, name)
+
+
+    def __repr__(self):
+        return f"<LazyModel {self.filename}{'' if self._model is None else ' (loaded)'}>"
+
+
+class PatchSession:
+    """Patches applied to the plain data of a model, which is only validated
+       when the session is committed"""
+    def __init__(self, model: Model):
+        self.model = model
+        # a trusted model is validated when the patches are committed
+        self.data = model.data.model_dump() if model.validated else copy.deepcopy(model._raw)
+        self.changed = False
+
+
+    @traced("Model.patch")
+    def patch(self, defaults: dict, create: bool=True, variables: dict = None):
+        """Apply patches to the data"""
+        for k, v in defaults.items():
+            self.changed = True
+            if variables:
+                # try to do variable substitution in the value
+                v = str(v).format_map(variables)
+            jpath = parse_path(k)
+            if create:
+                jpath.update_or_create(self.data, v)
+            else:
+                if not jpath.find(self.data):
+                    raise KeyError(f"Setting default value for {k} but it wasn't found in the tree")
+                jpath.update(self.data, v)
+
+
+    @traced("Model.validate")
+    def commit(self):
+        """Validate the patched data and store it in the model"""
+        if self.changed:
+            self.model.data = self.model.model(**self.data)
+
+
+_write_session: contextvars.ContextVar["WriteSession"] = contextvars.ContextVar("dwim_write_session", default=None)
+
+class WriteSession:
+    """Model files which are written together.  While the session is open,
+       Model.write_file only renders the text, and when it's flushed the
+       files are written by a pool of threads.  Each file is written to a
+       temporary file and renamed over the target, so a reader never sees
+       half a file.  The last write of a file wins.
+
+       Whatever goes with the files is done by the flush too, so a process
+       which dies before the flush leaves nothing behind:  the directories
+       for the files are made first, and the things which depend on the
+       files (like empty stub files and index entries) are done after the
+       files are written.
+
+       The session doesn't promise that the files survive a crash unless
+       both kinds of sync are on.  With sync_directories (the default) each
+       directory is synced once after the renames, which makes the renames
+       themselves stick.  The file data is only synced with sync_files,
+       since on NFS that's a round trip to the server for every file, and
+       the writes never synced before.  Without it, a file renamed just
+       before a crash can come back empty or cut short on some filesystems
+       (XFS, say)."""
+    def __init__(self, workers: int=8, sync_directories: bool=True, sync_files: bool=False):
+        self.workers = workers
+        self.sync_directories = sync_directories
+        self.sync_files = sync_files
+        self.pending: dict[Path, str] = {}
+        self.directories: list[Path] = []
+        self.actions: list[Callable[[], None]] = []
+        self.stats: list[dict] = []
+        self._lock = threading.Lock()
+
+
+    def add(self, filename: Path, text: str):
+        """Queue a file to be written"""
+        with self._lock:
+            self.pending[Path(os.path.abspath(filename))] = text
+
+
+    def get(self, filename: Path) -> str:
+        """Get the text queued for a file, or None"""
+        with self._lock:
+            return self.pending.get(Path(os.path.abspath(filename)))
+
+
+    def add_directory(self, directory: Path):
+        """Queue a directory to be made before the files are written"""
+        with self._lock:
+            self.directories.append(Path(directory))
+
+
+    def add_action(self, action: Callable[[], None]):
+        """Queue something to do after the files are written"""
+        with self._lock:
+            self.actions.append(action)
+
+
+    @traced("WriteSession.flush")
+    def flush(self) -> dict:
+        """Make the queued directories, write the queued files, and then do
+           the queued actions.  Returns the stats for the files (or None if
+           there weren't any)."""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            directories, self.directories = self.directories, []
+            actions, self.actions = self.actions, []
+        for directory in directories:
+            directory.mkdir(parents=True, exist_ok=True)
+        stats = self._write(pending) if pending else None
+        for action in actions:
+            action()
+        return stats
+
+
+    def _write(self, pending: dict[Path, str]) -> dict:
+        start = time.perf_counter()
+        directories = {f.parent for f in pending}
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(pending))) as pool:
+            latencies = list(pool.map(lambda item: _write_replace(*item, self.sync_files), pending.items()))
+            if self.sync_directories:
+                list(pool.map(_fsync_directory, directories))
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        size = sum(len(t.encode()) for t in pending.values())
+        stats = {'files': len(pending),
+                 'bytes': size,
+                 'directories': len(directories),
+                 'seconds': round(elapsed, 6),
+                 'files_per_second': round(len(pending) / elapsed, 1) if elapsed else None,
+                 'mb_per_second': round(size / 1e6 / elapsed, 3) if elapsed else None,
+                 'latency_p50_ms': round(statistics.median(latencies) * 1000, 3),
+                 'latency_max_ms': round(latencies[-1] * 1000, 3)}
+        self.stats.append(stats)
+        logging.info(f"Wrote {stats['files']} files ({size / 1000:.1f} kB) in {stats['directories']} directories "
+                     f"in {elapsed:.3f}s: {stats['files_per_second']} files/s, "
+                     f"latency p50 {stats['latency_p50_ms']}ms, max {stats['latency_max_ms']}ms")
+        return stats
+
+
+def _pending_text(filename: Path) -> str:
+    """The text waiting to be written to a file by the write session"""
+    session = _write_session.get()
+    return session.get(filename) if session else None
+
+
+def file_exists(filename: Path) -> bool:
+    """Check if a model file exists, including one which the write session
+       hasn't written yet"""
+    return _pending_text(filename) is not None or filename.exists()
+
+
+def make_directory(directory: Path):
+    """Make a directory (if it isn't already there), or have the write
+       session make it when it's flushed"""
+    if (session := _write_session.get()) is not None:
+        session.add_directory(directory)
+    else:
+        directory.mkdir(parents=True, exist_ok=True)
+
+
+def after_write(action: Callable[[], None]):
+    """Do something which depends on the model files being written:  now,
+       or after the write session's files are written"""
+    if (session := _write_session.get()) is not None:
+        session.add_action(action)
+    else:
+        action()
+
+
+@contextmanager
+def write_session(workers: int=8, sync_directories: bool=True, sync_files: bool=False):
+    """Group the model writes in the block, flushing them when it exits (even
+       if it raises, since the files would have been written without the
+       session).  A nested session is part of the outer one.
+
+           with write_session() as session:
+               project.add_physical_objects(profile, objects)
+    """
+    if (session := _write_session.get()) is not None:
+        yield session
+        return
+    session = WriteSession(workers, sync_directories, sync_files)
+    token = _write_session.set(session)
+    try:
+        yield session
+    finally:
+        _write_session.reset(token)
+        session.flush()
+
+
+def _write_replace(filename: Path, text: str, sync: bool) -> float:
+    """Write a file through a temporary file (syncing it if sync is set),
+       returning how long it took"""
+    start = time.perf_counter()
+    tmpfile = filename.with_name(f".{filename.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmpfile, "w") as f:
+            f.write(text)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmpfile, filename)
+    except BaseException:
+        tmpfile.unlink(missing_ok=True)
+        raise
+    return time.perf_counter() - start
+
+
+def _fsync_directory(directory: Path):
+    """Sync a directory, so the renames in it stick"""
+    try:
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError as e:
+        logging.debug(f"Cannot open {directory} to sync it: {e}")
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logging.debug(f"Cannot sync {directory}: {e}")
+    finally:
+        os.close(fd)
@@ -40,6 +40,16 @@ class MediaBase(BaseModel):
     problems: ProblemsBase
 
 
+class Fixity(BaseModel):
+    """Checksums of a media file.  Digests from other algorithms can be added."""
+    model_config = ConfigDict(extra='allow')
+    size: int = Field(default=0, description="Size of the file in bytes")
+    md5: str = Field(default='', description="MD5 digest of the file")
+    sha256: str = Field(default='', description="SHA-256 digest of the file")
+    computed: str = Field(default='', description="When the digests were computed",
+                          json_schema_extra={'format': 'date-time'})
+
+
 class SequenceBase(BaseModel):
     """Information related to a digitization sequence"""
     system: System # placeholder for media-specific subclass
@@ -47,6 +57,8 @@ class SequenceBase(BaseModel):
                        description="Label to identify the part of the media being digitized")
     comments: str = Field(default="no comment",
                           description="Comments for anything strange or abnormal about the content")
+    fixity: dict[str, Fixity] = Field(default_factory=dict,
+                                      description="Checksums of the sequence's media files, by file name")
     
 
 SeverityScale = string_enum("SeverityScale", ['none', 'minor', 'moderate', 'severe'])    
@@ -0,0 +1,92 @@
+"""Persistent cache of probe results, keyed on file identity"""
+import sqlite3
+import json
+import os
+import threading
+import logging
+from pathlib import Path
+from .utils import find_project_root
+
+
+class ProbeCache:
+    """An SQLite-backed cache of Probulator results.  An entry is only used
+       when the path, size, mtime_ns, and inode of the file all still match
+       what they were when the file was probed."""
+    def __init__(self, dbfile: Path):
+        self.dbfile = Path(dbfile)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.dbfile, check_same_thread=False)
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS probe (
+                                    path TEXT PRIMARY KEY,
+                                    size INTEGER NOT NULL,
+                                    mtime_ns INTEGER NOT NULL,
+                                    inode INTEGER NOT NULL,
+                                    metadata TEXT NOT NULL)""")
+
+
+    @staticmethod
+    def identity(file: Path) -> tuple[str, int, int, int]:
+        """Get the (path, size, mtime_ns, inode) key for a file.  Take this
+           before probing so a file that changes mid-probe isn't cached
+           under its new identity."""
+        path = os.path.abspath(file)
+        st = os.stat(path)
+        return path, st.st_size, st.st_mtime_ns, st.st_ino
+
+
+    def get(self, key: tuple) -> dict:
+        """Get the cached metadata for a file identity, or None if it isn't
+           cached or the file has changed"""
+        with self._lock:
+            row = self._db.execute("SELECT metadata FROM probe WHERE path=? AND size=? AND mtime_ns=? AND inode=?",
+                                   key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+
+    def put(self, key: tuple, metadata: dict):
+        """Store the metadata for a file identity"""
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO probe (path, size, mtime_ns, inode, metadata) VALUES (?, ?, ?, ?, ?)",
+                             (*key, json.dumps(metadata)))
+
+
+    def invalidate(self, paths: list[Path]=None) -> int:
+        """Remove the entries for the given files (or everything beneath the
+           given directories), or all entries if no paths are given.  Returns
+           the number of entries removed."""
+        with self._lock, self._db:
+            if not paths:
+                return self._db.execute("DELETE FROM probe").rowcount
+            count = 0
+            for p in paths:
+                p = os.path.abspath(p)
+                prefix = p.rstrip(os.sep) + os.sep
+                count += self._db.execute("DELETE FROM probe WHERE path=? OR substr(path, 1, ?)=?",
+                                          (p, len(prefix), prefix)).rowcount
+            return count
+
+
+    def entries(self) -> int:
+        """Number of entries in the cache"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM probe").fetchone()[0]
+
+
+    def close(self):
+        """Close the database"""
+        with self._lock:
+            self._db.close()
+        logging.debug(f"Probe cache {self.dbfile}: {self.hits} hits, {self.misses} misses")
+
+
+def default_cache_file(directory: Path) -> Path:
+    """The cache file for the project containing the directory"""
+    root = find_project_root(directory)
+    return None if root is None else root / ".probe_cache.sqlite"
@@ -2,8 +2,17 @@
 import subprocess
 import logging
 import json
+import os
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Iterable, Iterator
 import magic
+from .profiles import Profile
+from .probecache import ProbeCache
+from .classifier import FileClassifier
+from .trace import span
 
 
 class Probulator:
@@ -11,19 +20,55 @@ class Probulator:
         'ffprobe': 'ffprobe'
     }
 
+    def __init__(self, max_processes: int=None, cache: ProbeCache=None):
+        """Create a probulator.  If max_processes is given, no more than that
+           many probe subprocesses will be running at once for this instance.
+           If a cache is given, files which haven't changed since they were
+           last probed are not probed again."""
+        self.binaries = dict(Probulator.binaries)
+        self.cache = cache
+        self._process_limit = threading.BoundedSemaphore(max_processes) if max_processes else contextlib.nullcontext()
+
+
     def configure_binaries(self, binaries: dict):
         """Update the paths for any binaries used by the Probulator"""
-        self._binaries.update(**binaries)
+        self.binaries.update(**binaries)
 
 
     def get_metadata(self, file: Path) -> dict:
         """Get structured technical metadata from a file"""
+        if self.cache:
+            key = self.cache.identity(file)
+            if (data := self.cache.get(key)) is not None:
+                return data
         mime = magic.from_file(file, mime=True)
         family, fmt = mime.split('/')
         if family in ('audio', 'video'):
-            return self._get_av_metadata(file, mime)
+            data = self._get_av_metadata(file, mime)
         else:
             raise NotImplementedError(f"Cannot handle files with family mime {family}")
+        if self.cache:
+            self.cache.put(key, data)
+        return data
+
+
+    def probe_many(self, files: Iterable[Path], workers: int=None) -> Iterator[tuple[Path, dict, Exception]]:
+        """Probe files concurrently, yielding (file, metadata, error) as each
+           one finishes.  Exactly one of metadata and error will be None, so a
+           failed probe doesn't stop the rest of the batch."""
+        workers = workers or os.cpu_count() or 1
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {pool.submit(self.get_metadata, f): f for f in files}
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    yield file, future.result(), None
+                except Exception as e:
+                    logging.debug(f"Probe of {file} failed: {e}")
+                    yield file, None, e
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
 
 
     def _get_av_metadata(self, file: Path, mime: str) -> dict:
@@ -37,11 +82,12 @@ class Probulator:
                 'audio': [],
                 'video': []}
 
-        p = subprocess.run([self.binaries['ffprobe'], 
-                            '-show_format', '-show_streams', '-print_format', 'json',
-                            '-loglevel', 'quiet', str(file)], 
-                            stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
-                            check=True, encoding='utf8')
+        with self._process_limit, span("ffprobe"):
+            p = subprocess.run([self.binaries['ffprobe'], 
+                                '-show_format', '-show_streams', '-print_format', 'json',
+                                '-loglevel', 'quiet', str(file)], 
+                                stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                                check=True, encoding='utf8')
         pdata = json.loads(p.stdout)
         formatters = {'s': lambda x: None if x is None else str(x), 
                       'f': lambda x: None if x is None else float(x), 
@@ -82,6 +128,24 @@ class Probulator:
         return data
 
 
+def find_media_files(directory: Path, profile: Profile) -> Iterator[Path]:
+    """Find the media files in a project or physical object directory which
+       match one of the profile's use patterns.  Empty files (the stubs
+       created by Project.add_sequence) are skipped."""
+    classifier = FileClassifier(profile)
+
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if classifier.classify(name) is None:
+                continue
+            file = Path(dirpath, name)
+            if file.stat().st_size == 0:
+                logging.debug(f"Skipping empty file {file}")
+                continue
+            yield file
+
+
 if __name__ == "__main__":
     import argparse
     import yaml
@@ -2,9 +2,16 @@ import logging
 import yaml
 from pathlib import Path
 import sys
-from pydantic import BaseModel, Field
-from typing import Any
+import os
+from functools import cached_property
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import Any, TYPE_CHECKING
 from mergedeep import merge
+from . import yamlio
+from .trace import traced
+from .utils import get_id_matcher, IdMatcher
+if TYPE_CHECKING:
+    from .qc import QCChecker
 
 
 class ProjectConfig(BaseModel):
@@ -22,12 +29,25 @@ class PhysicalConfig(BaseModel):
     sequence_count: int = 0
     sequence_defaults: dict[str, Any] = Field(default_factory=dict)
     uses: dict[str, "UseConfig"] = Field(default_factory=dict)
-    
+
+    @cached_property
+    def id_matcher(self) -> IdMatcher:
+        """The compiled matcher and validators for the whole ID"""
+        return get_id_matcher(self.id_pattern, self.id_validators, exact=True)
+
     
 class UseConfig(BaseModel):
     pattern: str
     has_metadata: bool = False
     optional: bool = False
+    qc: dict[str, list] = Field(default_factory=dict)
+
+    @cached_property
+    def qc_checker(self) -> "QCChecker":
+        """The compiled QC checks for this use"""
+        # imported here so loading a profile doesn't need jsonpath_ng
+        from .qc import compile_checks
+        return compile_checks(self.qc)
 
 
 class Profile(BaseModel):
@@ -35,10 +55,16 @@ class Profile(BaseModel):
     name: str
     project: ProjectConfig = Field(default_factory=ProjectConfig)
     physical_objects: dict[str, dict[str, Any]] = Field(default_factory=dict)
+    _po_configs: dict[str, PhysicalConfig] = PrivateAttr(default_factory=dict)
+    _sources: dict[Path, int] = PrivateAttr(default_factory=dict)
 
+    @traced("Profile.get_po_config")
     def get_po_config(self, physical_type: str) -> PhysicalConfig:
         """Get the physical object configuration, setting up inheritance as
-           needed."""
+           needed.  The resolved configuration is cached and shared, so don't
+           modify it."""
+        if (config := self._po_configs.get(physical_type)) is not None:
+            return config
         if physical_type not in self.physical_objects:
             raise KeyError(f"Physical type {physical_type} not defined!")
         if physical_type == 'default' or physical_type.startswith('_'):
@@ -50,23 +76,48 @@ class Profile(BaseModel):
                 raise ValueError(f"The parent physical object type {x} isn't defined!")
             merge(config, self.physical_objects[x])
 
-        return PhysicalConfig(**config)
+        config = PhysicalConfig(**config)
+        self._po_configs[physical_type] = config
+        return config
+
 
+    def is_stale(self) -> bool:
+        """Check if any of the files this profile was loaded from have
+           changed since it was loaded"""
+        return any(_mtime(f) != mtime for f, mtime in self._sources.items())
 
 
 
 
+
+_profiles: dict[str, Profile] = {}
+
+@traced("load_profile")
 def load_profile(name: str):
     """Load the default profile and override it with data from the named profile
-       if it exists"""
+       if it exists.  Profiles are cached until one of their files changes."""
+    if (profile := _profiles.get(name)) is not None and not profile.is_stale():
+        return profile
+
     profiles = []
+    sources = {}
     for n in ("default", name):    
         pfile = Path(sys.path[0], f"../etc/profile_{n}.yaml")
-        if pfile.exists():
+        sources[pfile] = _mtime(pfile)
+        if sources[pfile] is not None:
             with open(pfile) as f:
-                profiles.append(yaml.safe_load(f))
+                profiles.append(yamlio.load(f))
         else:
             profiles.append({})
-    profile = merge({}, *profiles)
-    return Profile(**profile)
+    profile = Profile(**merge({}, *profiles))
+    profile._sources = sources
+    _profiles[name] = profile
+    return profile
+
 
+def _mtime(file: Path) -> int:
+    """Modification time of a file, or None if it doesn't exist"""
+    try:
+        return os.stat(file).st_mtime_ns
+    except FileNotFoundError:
+        return None
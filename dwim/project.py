@@ -2,22 +2,32 @@ from pathlib import Path
 import logging
 import re
 #from .schemas import Schema
-from .model import Model
-from dwim.models.structure import Structure
-import yaml
-from .utils import validate_id
+import os
+from typing import Iterator, TYPE_CHECKING
+from .model import Model, LazyModel, file_exists, make_directory, after_write
+from . import yamlio
 from .profiles import Profile
+from .index import ProjectIndex, get_barcode
+from .shadow import ShadowCache
+if TYPE_CHECKING:
+    from dwim.models.structure import Structure
 
-class Project:
-    def __init__(self, rootdir: Path, name: str, create: bool=False, defaults: dict=None):
-        """Load or create a project"""
-        # verify the project id - I don't care, except that it can only be
-        # letters, digits, dashes, and underscores.
-        if not re.match("^[A-Za-z0-9][A-Za-z0-9_\\-]{3,}$", name):
-            raise ValueError("The project ID must be at least 4 characters, start with a letter or number and must only contain letters, numbers, dashes, and underscores")
 
+class Project:
+    def __init__(self, rootdir: Path, name: str, create: bool=False, defaults: dict=None,
+                 index: ProjectIndex=None, shadow: bool=False, trusted: bool=False):
+        """Load or create a project.  The index defaults to the one for the
+           root directory, which isn't opened until it's needed and is closed
+           with the project.  If shadow is set, the physical object and
+           sequence files are read through the project's shadow cache.  If
+           trusted is set, they aren't validated until they're changed."""
+        self.validate_name(name)
         self.name = name
         self.project_root = rootdir / name
+        self._index = index
+        self._own_index = index is None
+        self.shadow = None
+        self.trusted = trusted
         if not self.project_root.exists():
             # This project doesn't exist, so instantiate it if we're supposed to
             if not create:
@@ -27,91 +37,236 @@ class Project:
             self.project_root.mkdir()
             schema_dir = self.project_root / "schemas"
             schema_dir.mkdir()
-            project = Model("project")                                    
-            if defaults:
-                project.patch(defaults)
-            project.patch({"system.project_id": name})
+            project = Model("project")
+            with project.patching() as p:
+                if defaults:
+                    p.patch(defaults)
+                p.patch({"system.project_id": name})
             project.write_file(self.project_root / "project.yaml", 
                                schemadir=schema_dir)
+            self.index.add_project(name)
 
+        if shadow:
+            self.shadow = ShadowCache.for_project(self.project_root)
         self.refresh_project()
 
 
+    @property
+    def index(self) -> ProjectIndex:
+        """The index for the root directory, opened the first time it's used"""
+        if self._index is None:
+            self._index = ProjectIndex.for_root(self.project_root.parent)
+        return self._index
+
+
+    def close(self):
+        """Close the shadow cache (saving what was read into it) and the
+           index, if the project opened it"""
+        if self.shadow is not None:
+            self.shadow.close()
+            self.shadow = None
+        if self._own_index and self._index is not None:
+            self._index.close()
+            self._index = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    @staticmethod
+    def validate_name(name: str):
+        """Verify the project id - I don't care, except that it can only be
+           letters, digits, dashes, and underscores."""
+        if not re.match("^[A-Za-z0-9][A-Za-z0-9_\\-]{3,}$", name):
+            raise ValueError("The project ID must be at least 4 characters, start with a letter or number and must only contain letters, numbers, dashes, and underscores")
+
+
     def refresh_project(self):        
         """Load the project data from the disk"""
         # load the project
         with open(self.project_root / "project.yaml") as f:
-            self.project = yaml.safe_load(f)
+            self.project = yamlio.load(f)
 
         # load the physical objects
         ...
 
 
+    def iter_physical_objects(self) -> Iterator[LazyModel]:
+        """Iterate over the physical objects, in the order given by the
+           structure, and then any others in name order.  Nothing is read
+           until a handle's data is used, and what was read is saved in the
+           shadow cache when the iteration is done."""
+        try:
+            yield from self._iter_physical_objects()
+        finally:
+            if self.shadow is not None:
+                self.shadow.flush()
+
+
+    def _iter_physical_objects(self) -> Iterator[LazyModel]:
+        structfile = self.project_root / "structure.yaml"
+        order = []
+        if structfile.exists():
+            with open(structfile) as f:
+                order = (yamlio.load(f) or {}).get('object_structure', [])
+
+        present = set()
+        with os.scandir(self.project_root) as entries:
+            for entry in entries:
+                if entry.is_dir() and os.path.exists(os.path.join(entry.path, "physical_object.yaml")):
+                    present.add(entry.name)
+
+        for physical_id in order:
+            if physical_id in present:
+                present.discard(physical_id)
+                yield self._physical_object_handle(physical_id)
+        for physical_id in sorted(present):
+            logging.debug(f"Physical object {physical_id} isn't in the structure")
+            yield self._physical_object_handle(physical_id)
+
+
+    def _physical_object_handle(self, physical_id: str) -> LazyModel:
+        return LazyModel(self.project_root / physical_id / "physical_object.yaml",
+                         cache=self.shadow, trusted=self.trusted, physical_object_id=physical_id)
+
+
+    def iter_sequences(self, physical_id: str=None) -> Iterator[LazyModel]:
+        """Iterate over the sequence metadata for one physical object, or for
+           all of them in structure order.  Nothing is read until a handle's
+           data is used, and what was read is saved in the shadow cache when
+           the iteration is done."""
+        physical_ids = [physical_id] if physical_id else (x.physical_object_id for x in self._iter_physical_objects())
+        try:
+            for physical_id in physical_ids:
+                with os.scandir(self.project_root / physical_id) as entries:
+                    names = sorted(e.name for e in entries
+                                   if e.name.endswith(".yaml") and e.name != "physical_object.yaml" and e.is_file())
+                for name in names:
+                    yield LazyModel(self.project_root / physical_id / name,
+                                    cache=self.shadow, trusted=self.trusted, physical_object_id=physical_id)
+        finally:
+            if self.shadow is not None:
+                self.shadow.flush()
+
+
     def add_physical_object(self, profile: Profile, physical_id: str, physical_type: str,
                             defaults: dict=None, seq_defaults: dict=None):
         """Add a new physical object with the given ID and type"""
-        po_path = self.project_root / physical_id
-        if (po_path).exists():
-            raise FileExistsError(f"Physical object with ID {physical_id} already exists")
-        
-        # get the configuration and validate the 
-        config = profile.get_po_config(physical_type)        
-        id_fields = validate_id(physical_id, config.id_pattern, config.id_validators, exact=True)
-                
-        # get the schema for this type
-        media = Model(f"{physical_type}-media")        
-        media.patch(config.media_defaults)
-        media.patch(defaults)
-        media.patch({'system.profile': profile.name,
-                     'system.project_id': self.name,
-                     'system.physical_object_id': physical_id}) 
-        po_path.mkdir()
-        media.write_file(po_path / "physical_object.yaml",
-                         schemadir=self.project_root / "schemas")
-        
-        structfile = self.project_root / "structure.yaml"        
+        self.add_physical_objects(profile, [(physical_id, physical_type, defaults)],
+                                  seq_defaults=seq_defaults)
+
+
+    def add_physical_objects(self, profile: Profile, objects: list[tuple[str, str, dict]],
+                             seq_defaults: dict=None):
+        """Add new physical objects, given as (ID, type, defaults) tuples.  All
+           of the IDs are validated before anything is created and the
+           structure file is only written once.  In a write session, the
+           directories, stubs, and index entries are made when it's flushed,
+           along with the files."""
+        configs = {}
+        barcodes = {}
+        batch_ids = set()
+        batch_barcodes = set()
+        for physical_id, physical_type, _ in objects:
+            if physical_id in batch_ids:
+                raise ValueError(f"Physical object with ID {physical_id} is listed more than once")
+            batch_ids.add(physical_id)
+            # a directory without the metadata is left over from something
+            # which didn't finish, so it can be used
+            if file_exists(self.project_root / physical_id / "physical_object.yaml"):
+                raise FileExistsError(f"Physical object with ID {physical_id} already exists")
+
+            # get the configuration and validate the ID
+            if physical_type not in configs:
+                configs[physical_type] = profile.get_po_config(physical_type)
+            config = configs[physical_type]
+            barcode = get_barcode(config, config.id_matcher.match(physical_id))
+            if barcode is not None:
+                if barcode in batch_barcodes:
+                    raise ValueError(f"Barcode {barcode} is used more than once")
+                batch_barcodes.add(barcode)
+                barcodes[physical_id] = barcode
+        # barcodes have to be unique across all of the projects
+        self.index.check_barcodes(barcodes.values())
+
+        schemadir = self.project_root / "schemas"
+        structfile = self.project_root / "structure.yaml"
         struct = Model.read_file(structfile, empty_ok=True, model_name="structure")
         s: Structure = struct.data
-        s.object_structure.append(physical_id)
-        struct.write_file(structfile, 
-                          schemadir=self.project_root / "schemas")
+        in_structure = set(s.object_structure)
+        try:
+            for physical_id, physical_type, defaults in objects:
+                config = configs[physical_type]
+                # get the schema for this type
+                media = Model(f"{physical_type}-media")
+                with media.patching() as p:
+                    p.patch(config.media_defaults)
+                    if defaults:
+                        p.patch(defaults)
+                    p.patch({'system.profile': profile.name,
+                             'system.project_id': self.name,
+                             'system.physical_object_id': physical_id})
+                po_path = self.project_root / physical_id
+                make_directory(po_path)
+                media.write_file(po_path / "physical_object.yaml",
+                                 schemadir=schemadir)
+                after_write(lambda physical_id=physical_id, physical_type=physical_type:
+                            self.index.add_physical_object(self.name, physical_id, physical_type,
+                                                           profile.name, barcodes.get(physical_id)))
+                if physical_id in in_structure:
+                    logging.warning(f"Physical object {physical_id} is already in the structure")
+                else:
+                    s.object_structure.append(physical_id)
+                    in_structure.add(physical_id)
+        finally:
+            # record whatever was created, even if something went wrong.
+            struct.write_file(structfile, schemadir=schemadir)
 
-        if config.sequence_count:
-            # create sequence stubs
-            for s in range(1, config.sequence_count + 1):
-                self.add_sequence(profile, physical_id, physical_type, s, seq_defaults)
+        for physical_id, physical_type, _ in objects:
+            config = configs[physical_type]
+            if config.sequence_count:
+                # create sequence stubs
+                for seqno in range(1, config.sequence_count + 1):
+                    self.add_sequence(profile, physical_id, physical_type, seqno, seq_defaults)
 
 
     def add_sequence(self, profile: Profile, physical_id, physical_type, seqno, defaults: dict=None):
         """Add a media sequence to the physical object"""
         po_path: Path = self.project_root / physical_id
-        if not po_path.exists():
+        if not file_exists(po_path / "physical_object.yaml"):
             raise FileNotFoundError(f"Physical object with ID {physical_id} doesn't exist")
         config = profile.get_po_config(physical_type)        
-        id_fields = validate_id(physical_id, config.id_pattern, config.id_validators, exact=True)
+        id_fields = config.id_matcher.match(physical_id)
         
         for use, usedata in config.uses.items():
             if usedata.optional:
                 continue
             # create media stub file
-            (po_path / usedata.pattern.format(**id_fields, sequence_id=seqno)).touch()
+            after_write((po_path / usedata.pattern.format(**id_fields, sequence_id=seqno)).touch)
 
             #  create metadata if it's specified.
             if usedata.has_metadata:
                 seq_meta = Model(f"{physical_type}-sequence")
                 mdfile = po_path / ((usedata.pattern.format(**id_fields, sequence_id=seqno)) + ".yaml")
-                if mdfile.exists():
+                after_write(lambda mdfile=mdfile: self.index.add_sequence(self.name, physical_id, seqno, mdfile.name))
+                if file_exists(mdfile):
                     logging.warn(f"Not overwriting {mdfile} when creating sequence")
                     continue                
-                seq_meta.patch(config.sequence_defaults, variables={'project_id': self.name,
-                               'physical_object_id': physical_id,
-                               'sequence_id': seqno})
-                if defaults:
-                    seq_meta.patch(defaults)
-                seq_meta.patch({'system.profile': profile.name,
-                               'system.project_id': self.name,
-                               'system.physical_object_id': physical_id,
-                               'system.sequence_id': seqno})
+                with seq_meta.patching() as p:
+                    p.patch(config.sequence_defaults, variables={'project_id': self.name,
+                            'physical_object_id': physical_id,
+                            'sequence_id': seqno})
+                    if defaults:
+                        p.patch(defaults)
+                    p.patch({'system.profile': profile.name,
+                             'system.project_id': self.name,
+                             'system.physical_object_id': physical_id,
+                             'system.sequence_id': seqno})
                 seq_meta.write_file(mdfile, 
                                     schemadir=self.project_root / "schemas")                                
 
@@ -1,7 +1,15 @@
 import logging
 import json
 import re
+import datetime
 import jsonpath_ng
+from pathlib import Path
+from typing import Iterable, TYPE_CHECKING
+from .profiles import Profile
+from .classifier import FileClassifier, resolve_physical_type
+from .trace import traced
+if TYPE_CHECKING:
+    from .probulator import Probulator
 
 
 """
@@ -26,36 +34,7 @@ The value
 
 def test_data(data: dict, checks: dict) -> list[str]:
     """run the specified checks against the given data, and return a list of things that failed."""
-
-    results = {'general': []}    
-    for section, tests in checks.items():
-        if section not in data or len(data[section]) == 0:
-            results['general'].append(f"Checks for section {section} cannot run because it doesn't exist in the data")
-            continue
-        
-        data_to_test = []
-        if isinstance(data[section], list):
-            # there's a list of items...so we need to do it for all.
-            for i, sect in enumerate(data[section]):
-                data_to_test.append([sect, f"{section}-{i}"])
-        else:
-            # just do it for this set.
-            data_to_test.append([data[section], section])
-
-        for tdata, context in data_to_test:
-            res = []
-            for test in tests:
-                r = run_expression(tdata, test)
-                if r:
-                    res.extend(*[x[1:] for x in r])
-            results[context] = res
-
-    results = {k: v for k, v in results.items() if v}
-
-    return results
-
-
-
+    return compile_checks(checks).test(data)
 
 
 
@@ -155,9 +134,261 @@ def run_expression(data: dict, expr: dict, keep_true=False) -> list:
 
 def convert(old, new):
     """Convert the new data into the same type as the old data"""
+    if type(new) is type(old):
+        return new
+    if isinstance(old, datetime.date) and isinstance(new, str):
+        # YAML gives dates, and the checks give strings
+        return type(old).fromisoformat(new)
     return type(old)(new)
 
 
+class QCChecker:
+    """A set of QC checks compiled once and run against many data sets.
+
+       The json paths are parsed, the operators are resolved, and the
+       constant values are converted (once per data type) when the
+       checker is built, so only the comparisons themselves are done for
+       each data set.  A check which can't be compiled raises ValueError.
+    """
+    def __init__(self, checks: dict):
+        self.checks = checks
+        self._sections = []
+        for section, tests in checks.items():
+            try:
+                self._sections.append((section, [_compile_expression(t) for t in tests]))
+            except ValueError as e:
+                raise ValueError(f"Bad QC check for section {section}: {e}") from e
+
+
+    @traced("QCChecker.test")
+    def test(self, data: dict) -> dict[str, list]:
+        """Run the checks against the data, returning the things that failed
+           (in the same form as test_data)"""
+        results = {'general': []}
+        for section, tests in self._sections:
+            if section not in data or len(data[section]) == 0:
+                results['general'].append(f"Checks for section {section} cannot run because it doesn't exist in the data")
+                continue
+
+            if isinstance(data[section], list):
+                data_to_test = [(sect, f"{section}-{i}") for i, sect in enumerate(data[section])]
+            else:
+                data_to_test = [(data[section], section)]
+
+            for tdata, context in data_to_test:
+                res = []
+                for test in tests:
+                    for r in test(tdata):
+                        if not r[0]:
+                            res.extend(r[1:])
+                results[context] = res
+
+        return {k: v for k, v in results.items() if v}
+
+
+    def test_many(self, datasets: Iterable[dict]) -> list[dict[str, list]]:
+        """Run the checks against each of the data sets"""
+        test = self.test
+        return [test(data) for data in datasets]
+
+
+def compile_checks(checks: dict) -> QCChecker:
+    """Compile a check dict (such as a profile's uses.*.qc) for reuse"""
+    return QCChecker(checks)
+
+
+# the QC report for a media file goes next to its metadata file
+QC_REPORT_SUFFIX = ".qc.yaml"
+
+def qc_report_file(file: Path) -> Path:
+    """The QC report file for a media file"""
+    file = Path(file)
+    return file.with_name(file.name + QC_REPORT_SUFFIX)
+
+
+def qc_file(file: Path, profile: Profile, probulator: "Probulator"=None,
+            classifier: FileClassifier=None) -> dict:
+    """Probe a media file and run the QC checks that the profile has for its
+       use.  The physical type comes from the physical object's metadata when
+       several types share the file name pattern.  The probulator and the
+       classifier can be given so they're reused across many files."""
+    file = Path(file)
+    classifier = classifier or FileClassifier(profile)
+    fc = classifier.classify(file.name)
+    if fc is None:
+        raise ValueError(f"{file.name} doesn't match any of the uses in profile {profile.name}")
+    physical_type = resolve_physical_type(file, fc)
+    checker = profile.get_po_config(physical_type).uses[fc.use].qc_checker
+    if probulator is None:
+        from .probulator import Probulator
+        probulator = Probulator()
+    return {'file': str(file),
+            'physical_type': physical_type,
+            'use': fc.use,
+            'failures': checker.test(probulator.get_metadata(file)) if checker.checks else {}}
+
+
+_MISSING = object()
+
+def compile_path(path: str):
+    """Parse a json path once and return a function which returns a list
+       containing the first matching value (or an empty list)"""
+    p = jsonpath_ng.parse(path)
+    if isinstance(p, jsonpath_ng.Fields) and len(p.fields) == 1 and p.fields[0] != '*':
+        # a plain key is a dictionary lookup, so skip the jsonpath machinery
+        field = p.fields[0]
+        def resolve(data):
+            try:
+                value = data.get(field, _MISSING)
+            except (TypeError, AttributeError):
+                return []
+            return [] if value is _MISSING else [value]
+    else:
+        def resolve(data):
+            value = p.find(data)
+            return [value[0].value] if value else []
+    return resolve
+
+
+class Converted:
+    """A constant (or list of constants) converted to the type of whatever it
+       is compared against, cached per type"""
+    def __init__(self, raw, many=False):
+        self.raw = raw
+        self.many = many
+        self._cache = {}
+
+
+    def __call__(self, value):
+        vtype = type(value)
+        try:
+            return self._cache[vtype]
+        except KeyError:
+            pass
+        if self.many:
+            converted = [convert(value, x) for x in self.raw]
+            try:
+                converted = frozenset(converted)
+            except TypeError:
+                pass
+        else:
+            converted = convert(value, self.raw)
+        self._cache[vtype] = converted
+        return converted
+
+
+def _compile_expression(expr):
+    """Compile an expression into a function which returns all of the results
+       (true or not) in the same form as run_expression(..., keep_true=True).
+       Raises ValueError if the expression isn't a dict."""
+    if not isinstance(expr, dict):
+        raise ValueError(f"A QC check has to be a mapping, not {expr!r}")
+
+    terms = [_compile_term(k, v) for k, v in expr.items()]
+    def run(data):
+        results = []
+        for term in terms:
+            r = term(data)
+            if r is not None:
+                results.append(r)
+        return results
+    return run
+
+
+def _compile_term(k, v):
+    """Compile a single key/value pair of an expression"""
+    match k:
+        case '$and':
+            children = [_compile_expression(x) for x in v]
+            def term(data):
+                and_val = True
+                messages = []
+                for child in children:
+                    r = child(data)
+                    if any([x[0] == False for x in r]):
+                        and_val = False
+                    messages.append([x[1] for x in r])
+                return [and_val,
+                        f"Expected at all of these expressions to be true, but none of them are",
+                        *messages]
+            return term
+
+        case '$or':
+            children = [_compile_expression(x) for x in v]
+            def term(data):
+                or_val = False
+                messages = []
+                for child in children:
+                    r = child(data)
+                    if all([x[0] for x in r]):
+                        or_val = True
+                    messages.append([x[1] for x in r])
+                return [or_val,
+                        f"Expected at least one of these expressions to be true, but none of them are",
+                        *messages]
+            return term
+
+    resolve = compile_path(k)
+    check = _compile_operator(k, v)
+    def term(data):
+        value = resolve(data)
+        if not value:
+            return [False, f"The json path {k} doesn't exist in the test data"]
+        return check(value[0])
+    return term
+
+
+def _compile_operator(k, v):
+    """Compile the test for a resolved value.  Returns a function which takes
+       the value and returns the result (or None if the operator doesn't
+       produce one)"""
+    if not isinstance(v, dict):
+        return lambda value: [value == v, f"Expected {k} to be {v}, but it is {value}"]
+
+    # only the first key is the operator, like run_expression
+    k1 = list(v.keys())[0]
+    v1 = v[k1]
+    match k1:
+        case '$in':
+            values = Converted(v1, many=True)
+            return lambda value: [value in values(value),
+                                  f"Expected {k} to be one of these values {v1}, but it is {value}"]
+        case '$nin':
+            values = Converted(v1, many=True)
+            return lambda value: [value not in values(value),
+                                  f"Expected {k} not to be one of these values {v1}, but it is {value}"]
+        case '$regex':
+            regex = re.compile(str(v1))
+            return lambda value: [regex.search(str(value)) is not None,
+                                  f"Expected {k} to match the regex {v1}, but it is {value}"]
+        case '$eq':
+            other = Converted(v1)
+            return lambda value: [value == other(value),
+                                  f"Expected {k1} to be {v1} but got {value}"]
+        case '$ne':
+            other = Converted(v1)
+            return lambda value: [value != other(value),
+                                  f"Expected {k1} to not be {v1} but it is"]
+        case '$gt':
+            other = Converted(v1)
+            return lambda value: [value > other(value),
+                                  f"Expected {k1} to have a value greater than {v1}, but it is {value}"]
+        case '$lt':
+            other = Converted(v1)
+            return lambda value: [value < other(value),
+                                  f"Expected {k1} to be less than {v1}, but it is {value}"]
+        case '$gte':
+            other = Converted(v1)
+            return lambda value: [value >= other(value),
+                                  f"Expected {k1} to be greater than or equal to {v1}, but it is {value}"]
+        case '$lte':
+            other = Converted(v1)
+            return lambda value: [value <= other(value),
+                                  f"Expected {k1} to be less than or equal to {v1}, but it is {value}"]
+    # $within (and anything unknown) doesn't produce a result
+    return lambda value: None
+
+
 
 if __name__ == "__main__":
     import argparse
@@ -0,0 +1,405 @@
+"""
+Query the physical object and sequence metadata across projects
+
+The records are the same flattened records that dwim.export writes, one
+for each *-media and *-sequence file, held as columns:  one list per
+dotted path, with None where a record doesn't have the field.  Queries
+use the same mongo-style expressions as the QC checks:
+
+    {'schema_name': 'betacam-media',
+     'problems.common_problems': 'soft binder syndrome',
+     'problems.baked_date': {'$lt': '2025-01-01'}}
+
+with $and, $or, $in, $nin, $regex, $eq, $ne, $gt, $gte, $lt, and $lte.  A
+key which is a column is tested column by column; anything else is a json
+path which is resolved against each record that is still a candidate.  When
+the field is a list, a test matches if any of the items match ($ne and $nin
+match if all of them do).  A record which doesn't have the field (or has
+it empty) only matches $ne and $nin.  A test which can't be done (comparing
+a date with 'none', say) doesn't match.
+
+Building the columns means parsing every file, so each project's columns
+are cached in .dwim_snapshot.sqlite at the root, along with a signature
+made from the sizes and mtimes of the project's files.  Only the projects
+whose signature has changed are read again (through the project's shadow
+cache, so only the files which changed are parsed), and a SnapshotCache
+which is kept open (by the dwim service) keeps the merged snapshot in
+memory too.
+"""
+import os
+import re
+import time
+import pickle
+import operator
+import sqlite3
+import hashlib
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+from . import yamlio
+from .export import iter_records, JOIN_KEYS
+from .status import find_projects
+from .shadow import ShadowCache, safe_loads
+from .qc import QC_REPORT_SUFFIX, Converted, compile_path
+from .trace import traced
+
+
+SNAPSHOT_FILE = ".dwim_snapshot.sqlite"
+
+# part of every signature, so the cache is rebuilt when the layout changes
+SNAPSHOT_VERSION = 1
+
+# the fields which are shown when none are asked for
+DEFAULT_FIELDS = ('record_type', *JOIN_KEYS, 'file')
+
+# a filter is PATH OP VALUE:  "problems.baked_date<2025-01-01"
+_FILTER = re.compile(r"^(?P<path>.+?)\s*(?P<op>!=|<=|>=|=|<|>|~)\s*(?P<value>.*)$")
+FILTER_OPERATORS = {'=': '$eq', '!=': '$ne', '<': '$lt', '<=': '$lte', '>': '$gt', '>=': '$gte', '~': '$regex'}
+
+_PLAIN_PATH = re.compile(r"^(?:[\w\-]+|'[^']*')(?:\.(?:[\w\-]+|'[^']*'))*$")
+_PATH_PART = re.compile(r"'[^']*'|[^.]+")
+
+
+class Snapshot:
+    """The records of some projects, as columns"""
+    def __init__(self, columns: dict[str, list], size: int):
+        self.columns = columns
+        self.size = size
+
+
+    @staticmethod
+    def from_records(records) -> "Snapshot":
+        """Build a snapshot from flattened records"""
+        columns: dict[str, list] = {}
+        size = 0
+        for record in records:
+            for key, value in record.items():
+                if (column := columns.get(key)) is None:
+                    column = columns[key] = [None] * size
+                column.append(value)
+            size += 1
+            for column in columns.values():
+                if len(column) < size:
+                    column.append(None)
+        return Snapshot(columns, size)
+
+
+    @staticmethod
+    def merge(snapshots: list["Snapshot"]) -> "Snapshot":
+        """Put snapshots end to end"""
+        if len(snapshots) == 1:
+            return snapshots[0]
+        columns = {}
+        for name in dict.fromkeys(k for s in snapshots for k in s.columns):
+            column = columns[name] = []
+            for s in snapshots:
+                column.extend(s.columns.get(name) or [None] * s.size)
+        return Snapshot(columns, sum(s.size for s in snapshots))
+
+
+    def record(self, row: int, fields: list[str]=None) -> dict:
+        """Get a record, with only the given fields, or else all of the ones
+           it has"""
+        if fields:
+            return {f: self.columns[f][row] if f in self.columns else None for f in fields}
+        return {k: c[row] for k, c in self.columns.items() if c[row] is not None}
+
+
+    def nested(self, row: int) -> dict:
+        """Get a record with the dotted paths turned back into dicts"""
+        data = {}
+        for key, column in self.columns.items():
+            if (value := column[row]) is None:
+                continue
+            *parents, last = [p.strip("'") for p in _PATH_PART.findall(key)]
+            d = data
+            for p in parents:
+                d = d.setdefault(p, {})
+            d[last] = value
+        return data
+
+
+    @traced("Snapshot.select")
+    def select(self, expr: dict) -> list[int]:
+        """The rows which match a query expression"""
+        return list(compile_query(expr)(self, range(self.size)))
+
+
+def parse_filter(text: str) -> dict:
+    """Turn PATH OP VALUE into a query expression.  The value is read as a
+       YAML scalar, so numbers and dates are compared as numbers and dates."""
+    if not (m := _FILTER.match(text)):
+        raise ValueError(f"Cannot parse the filter {text!r}: it should be PATH OP VALUE, where OP is one of {' '.join(FILTER_OPERATORS)}")
+    value = m['value'] if m['op'] == '~' else yamlio.load(m['value'])
+    return {m['path']: {FILTER_OPERATORS[m['op']]: '' if value is None else value}}
+
+
+def build_query(filters: list[str]=(), where: list[str]=()) -> dict:
+    """Combine filters and query expressions (as JSON or YAML text) into one
+       expression which matches all of them"""
+    terms = [parse_filter(f) for f in filters]
+    for text in where:
+        if not isinstance(expr := yamlio.load(text), dict):
+            raise ValueError(f"The query expression {text!r} isn't a mapping")
+        terms.append(expr)
+    return {'$and': terms}
+
+
+def compile_query(expr: dict) -> Callable[[Snapshot, list[int]], list[int]]:
+    """Compile a query expression into a function which takes a snapshot
+       and the candidate rows, and returns the rows which match"""
+    if not isinstance(expr, dict):
+        raise ValueError(f"A query expression has to be a dict, not {expr!r}")
+    terms = [_compile_term(k, v) for k, v in expr.items()]
+    def run(snapshot: Snapshot, rows):
+        for term in terms:
+            rows = term(snapshot, rows)
+        return rows
+    return run
+
+
+def _compile_term(k: str, v):
+    match k:
+        case '$and':
+            return _compile_and(v)
+        case '$or':
+            children = [compile_query(x) for x in v]
+            def term(snapshot, rows):
+                rows = list(rows)
+                matched = set()
+                for child in children:
+                    matched.update(child(snapshot, [r for r in rows if r not in matched]))
+                return [r for r in rows if r in matched]
+            return term
+
+    predicate = _compile_predicate(k, v)
+    # a missing field is "not equal" to anything
+    negative = isinstance(v, dict) and next(iter(v), None) in ('$ne', '$nin')
+    path = k.removeprefix("$.")
+    if _PLAIN_PATH.match(path):
+        def term(snapshot, rows):
+            if (column := snapshot.columns.get(path)) is None:
+                return list(rows) if negative else []
+            return [r for r in rows if predicate(column[r])]
+    else:
+        resolve = compile_path(k)
+        def test(data):
+            value = resolve(data)
+            return predicate(value[0]) if value else negative
+        def term(snapshot, rows):
+            return [r for r in rows if test(snapshot.nested(r))]
+    return term
+
+
+def _compile_and(children: list):
+    children = [compile_query(x) for x in children]
+    def term(snapshot, rows):
+        for child in children:
+            rows = child(snapshot, rows)
+        return rows
+    return term
+
+
+_COMPARISONS = {'$eq': operator.eq,
+                '$ne': operator.ne,
+                '$gt': operator.gt,
+                '$gte': operator.ge,
+                '$lt': operator.lt,
+                '$lte': operator.le}
+
+def _compile_predicate(k: str, v) -> Callable[[object], bool]:
+    """Compile the test for a value, converting the constants to the type
+       of the value the same way the QC checks do"""
+    if not isinstance(v, dict):
+        v = {'$eq': v}
+    # only the first key is the operator, like the QC checks
+    k1, v1 = next(iter(v.items()))
+    negative = k1 in ('$ne', '$nin')
+    match k1:
+        case '$in' | '$nin':
+            values = Converted(v1, many=True)
+            test = lambda value: (value in values(value)) != negative
+        case '$regex':
+            regex = re.compile(str(v1))
+            test = lambda value: regex.search(str(value)) is not None
+        case '$gt' | '$gte' | '$lt' | '$lte' if isinstance(v1, (datetime.date, int, float)) and not isinstance(v1, bool):
+            # a date or a number is only compared with values of the same
+            # kind, so 'none' isn't after 2024-01-01
+            kind = datetime.date if isinstance(v1, datetime.date) else (int, float)
+            other = Converted(v1)
+            compare = _COMPARISONS[k1]
+            test = lambda value: isinstance(value, kind) and compare(value, other(value))
+        case _ if k1 in _COMPARISONS:
+            other = Converted(v1)
+            compare = _COMPARISONS[k1]
+            test = lambda value: compare(value, other(value))
+        case _:
+            raise ValueError(f"Unknown operator {k1} for {k}")
+
+    def safe_test(value):
+        try:
+            return test(value)
+        except (TypeError, ValueError):
+            return False
+
+    def predicate(value):
+        if value is None:
+            return negative
+        if isinstance(value, list):
+            return all(map(safe_test, value)) if negative else any(map(safe_test, value))
+        return safe_test(value)
+    return predicate
+
+
+def snapshot_file(directory: Path) -> Path:
+    """The snapshot cache for a project root, or for the root that a single
+       project is in"""
+    directory = Path(directory).absolute()
+    if (directory / "project.yaml").exists():
+        directory = directory.parent
+    return directory / SNAPSHOT_FILE
+
+
+def project_signature(project_dir: Path) -> str:
+    """A digest of the names, sizes, and mtimes of a project's model files"""
+    h = hashlib.blake2b(f"{SNAPSHOT_VERSION}\n".encode(), digest_size=16)
+    with os.scandir(project_dir) as entries:
+        entries = sorted(entries, key=lambda e: e.name)
+    for entry in entries:
+        if entry.name.startswith('.') or entry.name == "schemas":
+            continue
+        if entry.is_dir():
+            with os.scandir(entry.path) as files:
+                files = sorted((f for f in files if f.name.endswith(".yaml") and not f.name.endswith(QC_REPORT_SUFFIX)),
+                               key=lambda f: f.name)
+            for f in files:
+                st = f.stat()
+                h.update(f"{entry.name}/{f.name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        elif entry.name.endswith(".yaml"):
+            st = entry.stat()
+            h.update(f"{entry.name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+class SnapshotCache:
+    """The columns of each project, cached in an SQLite database (and in
+       memory) by the project's signature"""
+    def __init__(self, dbfile: Path):
+        self.dbfile = Path(dbfile)
+        self.rebuilt = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.dbfile, check_same_thread=False)
+        with self._db:
+            self._db.execute("""CREATE TABLE IF NOT EXISTS snapshot (
+                                    project TEXT PRIMARY KEY,
+                                    signature TEXT NOT NULL,
+                                    data BLOB NOT NULL)""")
+        # project name -> (signature, snapshot)
+        self._projects: dict[str, tuple[str, Snapshot]] = {}
+        self._merged: tuple[tuple, Snapshot] = ((), None)
+
+
+    @staticmethod
+    def for_directory(directory: Path) -> "SnapshotCache":
+        """Open the cache for a project root, or for the root that a single
+           project is in"""
+        return SnapshotCache(snapshot_file(directory))
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+    @traced("SnapshotCache.snapshot")
+    def snapshot(self, directory: Path, workers: int=None) -> Snapshot:
+        """Get the snapshot of a project (or a directory of projects),
+           reading only the projects which have changed"""
+        projects = find_projects(directory)
+        workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            signatures = list(pool.map(project_signature, projects))
+            key = tuple(zip((p.name for p in projects), signatures))
+            with self._lock:
+                if key == self._merged[0]:
+                    return self._merged[1]
+
+            stale = []
+            for project_dir, signature in zip(projects, signatures):
+                if self._cached(project_dir.name, signature) is None:
+                    stale.append((project_dir, signature))
+            if stale:
+                logging.info(f"Reading {len(stale)} of {len(projects)} projects for the snapshot")
+            for _ in pool.map(lambda job: self._rebuild(*job), stale):
+                pass
+            with self._lock:
+                self._db.commit()
+                self.rebuilt += len(stale)
+
+        with self._lock:
+            snapshot = Snapshot.merge([self._projects[p.name][1] for p in projects]) if projects else Snapshot({}, 0)
+            self._merged = (key, snapshot)
+        return snapshot
+
+
+    def _cached(self, name: str, signature: str) -> Snapshot:
+        with self._lock:
+            if (cached := self._projects.get(name)) and cached[0] == signature:
+                return cached[1]
+            row = self._db.execute("SELECT data FROM snapshot WHERE project=? AND signature=?",
+                                   (name, signature)).fetchone()
+        if row is None:
+            return None
+        snapshot = Snapshot(*safe_loads(row[0]))
+        with self._lock:
+            self._projects[name] = (signature, snapshot)
+        return snapshot
+
+
+    def _rebuild(self, project_dir: Path, signature: str):
+        cache = ShadowCache.for_project(project_dir, required=False)
+        try:
+            snapshot = Snapshot.from_records(iter_records(project_dir, cache=cache))
+        finally:
+            if cache:
+                cache.close()
+        blob = pickle.dumps((snapshot.columns, snapshot.size), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO snapshot (project, signature, data) VALUES (?, ?, ?)",
+                             (project_dir.name, signature, blob))
+            self._projects[project_dir.name] = (signature, snapshot)
+
+
+def query(cache: SnapshotCache, directory: Path, expr: dict, fields: list[str]=None,
+          all_fields: bool=False, limit: int=None, workers: int=None) -> dict:
+    """Run a query, returning the number of matches, the records (with the
+       default fields and the ones in the query, unless fields or all_fields
+       is given), and how long it took"""
+    start = time.perf_counter()
+    snapshot = cache.snapshot(directory, workers)
+    loaded = time.perf_counter()
+    rows = snapshot.select(expr)
+    if not all_fields and not fields:
+        fields = list(dict.fromkeys([*DEFAULT_FIELDS, *_query_fields(expr)]))
+    records = [snapshot.record(r, None if all_fields else fields) for r in rows[:limit]]
+    return {'count': len(rows),
+            'total': snapshot.size,
+            'records': records,
+            'snapshot_seconds': round(loaded - start, 6),
+            'query_seconds': round(time.perf_counter() - loaded, 6)}
+
+
+def _query_fields(expr) -> list[str]:
+    """The plain paths used in an expression"""
+    fields = []
+    if isinstance(expr, dict):
+        for k, v in expr.items():
+            if k in ('$and', '$or'):
+                for x in v:
+                    fields.extend(_query_fields(x))
+            elif _PLAIN_PATH.match(k.removeprefix("$.")):
+                fields.append(k.removeprefix("$."))
+    return fields
@@ -0,0 +1,249 @@
+"""
+A long-running dwim service for the digitization stations
+
+Every run of a command line tool pays to import dwim, load the profile,
+resolve the physical object configurations, build the pydantic models, and
+open the probe caches.  The service does all of that once and keeps it:
+
+* profiles are cached by load_profile, which reloads one when any of its
+  files change, and a profile keeps its resolved PhysicalConfigs
+* the models, their JSON schemas, and the file classifier for each profile
+  are built the first time they're used
+* a probe cache (and the probulator using it) is kept open for each project
+* the query snapshot of each project root is kept in memory
+
+The tools forward their work to the service with dwim.client when it's
+running, and do it themselves when it isn't.
+"""
+import os
+import json
+import logging
+import signal
+import socketserver
+import threading
+from pathlib import Path
+from .client import ServiceClient, ServiceUnavailable, default_socket, check_owner
+from .profiles import Profile, load_profile
+from .classifier import FileClassifier
+from .probulator import Probulator, find_media_files
+from .probecache import ProbeCache, default_cache_file
+from .project import Project
+from .index import ProjectIndex
+from .status import scan_status, summarize
+from .qc import qc_file
+from .query import SnapshotCache, query, build_query, snapshot_file
+
+
+class DwimService:
+    """The operations which the service provides, and the state which is
+       kept warm between them.  Paths given to the operations should be
+       absolute since the service doesn't share the caller's directory."""
+    def __init__(self, max_processes: int=None):
+        self.max_processes = max_processes
+        self._lock = threading.Lock()
+        # changes to the projects are made one at a time
+        self._write_lock = threading.Lock()
+        self._classifiers: dict[str, tuple[Profile, FileClassifier]] = {}
+        self._probulators: dict[Path, Probulator] = {}
+        self._snapshots: dict[Path, SnapshotCache] = {}
+        self.ops = {'ping': self.ping,
+                    'add_physical_object': self.add_physical_object,
+                    'add_sequence': self.add_sequence,
+                    'probe': self.probe,
+                    'qc': self.qc,
+                    'status': self.status,
+                    'query': self.query}
+
+
+    def handle(self, op: str, args: dict):
+        """Run an operation"""
+        if op not in self.ops:
+            raise KeyError(f"Unknown operation {op}")
+        return self.ops[op](**args)
+
+
+    def profile(self, name: str) -> Profile:
+        """Get a profile, reloaded if its files have changed"""
+        with self._lock:
+            return load_profile(name)
+
+
+    def classifier(self, profile: Profile) -> FileClassifier:
+        """Get the file classifier for a profile, rebuilt when the profile is"""
+        with self._lock:
+            cached = self._classifiers.get(profile.name)
+            if cached is None or cached[0] is not profile:
+                cached = self._classifiers[profile.name] = (profile, FileClassifier(profile))
+            return cached[1]
+
+
+    def probulator(self, directory: Path) -> Probulator:
+        """Get the probulator for the project containing the directory (or
+           file), which keeps the project's probe cache open"""
+        cachefile = default_cache_file(directory)
+        with self._lock:
+            if (probulator := self._probulators.get(cachefile)) is None:
+                cache = ProbeCache(cachefile) if cachefile else None
+                probulator = self._probulators[cachefile] = Probulator(max_processes=self.max_processes, cache=cache)
+            return probulator
+
+
+    def snapshot_cache(self, directory: Path) -> SnapshotCache:
+        """Get the query snapshot cache for the root containing the directory"""
+        dbfile = snapshot_file(directory)
+        with self._lock:
+            if (cache := self._snapshots.get(dbfile)) is None:
+                cache = self._snapshots[dbfile] = SnapshotCache(dbfile)
+            return cache
+
+
+    def close(self):
+        """Close the probe caches and the snapshot caches"""
+        with self._lock:
+            for probulator in self._probulators.values():
+                if probulator.cache:
+                    probulator.cache.close()
+            self._probulators.clear()
+            for cache in self._snapshots.values():
+                cache.close()
+            self._snapshots.clear()
+
+
+    def ping(self) -> dict:
+        return {'pid': os.getpid()}
+
+
+    def add_physical_object(self, profile: str, rootdir: str, project: str, physical_id: str,
+                            physical_type: str, defaults: dict=None, seq_defaults: dict=None):
+        """Add a physical object (and its sequences) to a project"""
+        profile = self.profile(profile)
+        with self._write_lock:
+            index = ProjectIndex.for_root(Path(rootdir))
+            try:
+                Project(Path(rootdir), project, index=index).add_physical_object(
+                    profile, physical_id, physical_type, defaults=defaults or {}, seq_defaults=seq_defaults or {})
+            finally:
+                index.close()
+
+
+    def add_sequence(self, profile: str, rootdir: str, project: str, physical_id: str,
+                     physical_type: str, sequence_id: int, defaults: dict=None):
+        """Add a sequence to a physical object"""
+        profile = self.profile(profile)
+        with self._write_lock:
+            index = ProjectIndex.for_root(Path(rootdir))
+            try:
+                Project(Path(rootdir), project, index=index).add_sequence(
+                    profile, physical_id, physical_type, sequence_id, defaults)
+            finally:
+                index.close()
+
+
+    def probe(self, profile: str, directory: str, workers: int=None) -> dict:
+        """Probe the media files in a directory, returning the metadata and
+           the errors for each file"""
+        profile = self.profile(profile)
+        files = list(find_media_files(Path(directory), profile))
+        results = {'metadata': {}, 'errors': {}}
+        for file, metadata, error in self.probulator(Path(directory)).probe_many(files, workers=workers):
+            if error:
+                results['errors'][str(file)] = str(error)
+            else:
+                results['metadata'][str(file)] = metadata
+        return results
+
+
+    def qc(self, profile: str, files: list[str]) -> list[dict]:
+        """Probe and QC media files with the profile's checks for their use"""
+        profile = self.profile(profile)
+        classifier = self.classifier(profile)
+        reports = []
+        for file in files:
+            try:
+                reports.append(qc_file(Path(file), profile, self.probulator(Path(file).parent), classifier))
+            except Exception as e:
+                reports.append({'file': file, 'error': str(e)})
+        return reports
+
+
+    def status(self, profile: str, directory: str, workers: int=None) -> dict:
+        """Scan a project (or directory of projects) for missing, empty, and
+           extra files, returning the reports and their totals"""
+        reports = list(scan_status(Path(directory), self.profile(profile), workers=workers))
+        return {'reports': reports, 'totals': summarize(reports)}
+
+
+    def query(self, directory: str, filters: list[str]=(), where: list[str]=(), fields: list[str]=None,
+              all_fields: bool=False, limit: int=None, workers: int=None) -> dict:
+        """Query the physical object and sequence metadata of a project (or
+           directory of projects), with the snapshot kept between queries.
+           The filters and expressions are parsed here, so dates stay dates."""
+        return query(self.snapshot_cache(Path(directory)), Path(directory), build_query(filters, where),
+                     fields=fields, all_fields=all_fields, limit=limit, workers=workers)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """Handle the requests on one connection"""
+    def handle(self):
+        service: DwimService = self.server.service
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                result = service.handle(request['op'], request.get('args') or {})
+                response = {'ok': True, 'result': result}
+            except Exception as e:
+                logging.debug(f"Request failed: {line!r}", exc_info=True)
+                response = {'ok': False, 'error': str(e), 'type': type(e).__name__}
+            self.wfile.write(json.dumps(response, default=str).encode() + b"\n")
+            self.wfile.flush()
+
+
+class DwimServer(socketserver.ThreadingUnixStreamServer):
+    """Serve a DwimService on a Unix socket, one thread per connection"""
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, service: DwimService):
+        self.socket_path = Path(socket_path)
+        self.service = service
+        if not self.socket_path.parent.exists():
+            # the private directory for the default socket
+            self.socket_path.parent.mkdir(mode=0o700, parents=True)
+        if self.socket_path.exists():
+            # a socket left behind by a service which died can be replaced,
+            # but not one which is still being served.
+            client = ServiceClient(self.socket_path, timeout=2)
+            try:
+                client.connect()
+            except ServiceUnavailable:
+                check_owner(self.socket_path)
+                self.socket_path.unlink()
+            else:
+                raise RuntimeError(f"A dwim service is already running on {self.socket_path}")
+            finally:
+                client.close()
+        # the socket is created private, rather than changed after bind
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(self.socket_path), _Handler)
+        finally:
+            os.umask(umask)
+
+
+    def server_close(self):
+        super().server_close()
+        self.socket_path.unlink(missing_ok=True)
+        self.service.close()
+
+
+def serve(socket_path: Path=None, max_processes: int=None):
+    """Run the service until it's interrupted"""
+    socket_path = Path(socket_path or default_socket())
+    with DwimServer(socket_path, DwimService(max_processes=max_processes)) as server:
+        # stop cleanly (removing the socket) when the service is killed
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        logging.info(f"dwim service {os.getpid()} listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    logging.info("dwim service stopped")
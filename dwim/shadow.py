@@ -0,0 +1,127 @@
+"""
+Shadow cache of parsed model files
+
+The YAML files are the source of truth, but parsing thousands of them is
+slow.  The shadow cache keeps the parsed data for each file in an SQLite
+database next to the project, pickled, and keyed by the file's path,
+size, and mtime.  A stale or missing entry is simply re-read from the
+YAML and replaced.  The data is what the YAML parser produced, so the
+models and the reporting jobs (dwim.export and dwim.query) can share it.
+
+New entries are committed in batches, so anything which reads through the
+cache has to flush() or close() it when it's done.
+"""
+import sqlite3
+import pickle
+import io
+import os
+import datetime
+import logging
+import threading
+from pathlib import Path
+from . import yamlio
+
+
+SHADOW_FILE = ".dwim_shadow.sqlite"
+
+# the layout of the cached data:  a cache with another version is emptied
+SHADOW_VERSION = 2
+
+
+class _Unpickler(pickle.Unpickler):
+    """Only allow the types which YAML can produce, so a tampered cache
+       can't run anything"""
+    allowed = {('datetime', 'date'), ('datetime', 'datetime'), ('datetime', 'timezone'),
+               ('datetime', 'timedelta')}
+
+    def find_class(self, module, name):
+        if (module, name) in self.allowed:
+            return getattr(datetime, name)
+        raise pickle.UnpicklingError(f"{module}.{name} isn't allowed in the shadow cache")
+
+
+def safe_loads(blob: bytes):
+    """Unpickle data which can only contain the types that YAML produces"""
+    return _Unpickler(io.BytesIO(blob)).load()
+
+
+class ShadowCache:
+    """Parsed model data keyed on the file's path, size, and mtime_ns"""
+    # how many new entries to hold before committing them
+    commit_every = 500
+
+    def __init__(self, dbfile: Path):
+        self.dbfile = Path(dbfile)
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.dbfile, check_same_thread=False)
+        with self._db:
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SHADOW_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS shadow")
+                self._db.execute(f"PRAGMA user_version={SHADOW_VERSION}")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS shadow (
+                                    path TEXT PRIMARY KEY,
+                                    size INTEGER NOT NULL,
+                                    mtime_ns INTEGER NOT NULL,
+                                    data BLOB NOT NULL)""")
+
+
+    @staticmethod
+    def for_project(project_root: Path, required: bool=True) -> "ShadowCache":
+        """Open the shadow cache for a project.  If it isn't required, None
+           is returned when it can't be opened (in a read-only project, say)"""
+        try:
+            return ShadowCache(Path(project_root) / SHADOW_FILE)
+        except sqlite3.Error as e:
+            if required:
+                raise
+            logging.debug(f"Not using the shadow cache for {project_root}: {e}")
+            return None
+
+
+    def read(self, filename: Path, loader=None) -> dict:
+        """Get the data for a file, using loader(filename) (or the YAML
+           parser) to read it if the cache doesn't have a current copy"""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        with self._lock:
+            row = self._db.execute("SELECT data FROM shadow WHERE path=? AND size=? AND mtime_ns=?",
+                                   (path, st.st_size, st.st_mtime_ns)).fetchone()
+            if row is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if row is not None:
+            return safe_loads(row[0])
+
+        data = (loader or _load_yaml)(filename)
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO shadow (path, size, mtime_ns, data) VALUES (?, ?, ?, ?)",
+                             (path, st.st_size, st.st_mtime_ns, blob))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._db.commit()
+                self._pending = 0
+        return data
+
+
+    def flush(self):
+        """Commit any new entries"""
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+
+    def close(self):
+        """Commit and close the database"""
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+
+def _load_yaml(filename: Path):
+    with open(filename) as f:
+        return yamlio.load(f)
@@ -0,0 +1,135 @@
+"""Compare what is on the disk with what the profile expects"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+from . import yamlio
+from .profiles import Profile
+from .classifier import FileClassifier
+from .index import ProjectIndex, INDEX_FILE
+from .qc import QC_REPORT_SUFFIX
+
+
+def find_projects(directory: Path) -> list[Path]:
+    """The directory if it's a project, otherwise the projects in it"""
+    directory = Path(directory)
+    if (directory / "project.yaml").exists():
+        return [directory]
+    with os.scandir(directory) as entries:
+        return sorted(Path(e.path) for e in entries
+                      if e.is_dir() and os.path.exists(os.path.join(e.path, "project.yaml")))
+
+
+def scan_status(directory: Path, profile: Profile, workers: int=None) -> Iterator[dict]:
+    """Scan a project (or a directory of projects) and yield a report for
+       each physical object.  The physical object directories are scanned in
+       parallel, since on network storage the time is all spent waiting."""
+    classifier = FileClassifier(profile)
+    jobs = []
+    for project_dir in find_projects(directory):
+        types = _physical_types(project_dir)
+        with os.scandir(project_dir) as entries:
+            for e in sorted(entries, key=lambda e: e.name):
+                if e.is_dir() and e.name != "schemas":
+                    jobs.append((project_dir.name, e.path, types.get(e.name)))
+
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as pool:
+        yield from pool.map(lambda job: scan_physical_object(*job, profile, classifier), jobs)
+
+
+def _physical_types(project_dir: Path) -> dict[str, str]:
+    """Get the physical type of each object in the project from the index"""
+    index_file = project_dir.parent / INDEX_FILE
+    if not index_file.exists():
+        return {}
+    index = ProjectIndex(index_file)
+    try:
+        return {x['physical_object_id']: x['media_type'] for x in index.physical_objects(project_id=project_dir.name)}
+    finally:
+        index.close()
+
+
+def scan_physical_object(project_id: str, po_path: str, physical_type: str,
+                         profile: Profile, classifier: FileClassifier) -> dict:
+    """Scan one physical object directory.  Every file is put in one of:
+       * missing: a required file (or its metadata) isn't there
+       * empty: a required file is still the empty stub
+       * extra: a file the profile doesn't expect
+       * optional: an optional use which is present
+       and the rest are counted as ok"""
+    physical_id = os.path.basename(po_path)
+    report = {'project_id': project_id,
+              'physical_object_id': physical_id,
+              'physical_type': physical_type,
+              'missing': [], 'empty': [], 'extra': [], 'optional': [], 'ok': 0}
+
+    with os.scandir(po_path) as entries:
+        files = {e.name: e for e in entries}
+
+    if "physical_object.yaml" not in files:
+        report['missing'].append("physical_object.yaml")
+        report['extra'] = sorted(files)
+        return report
+    if physical_type is None:
+        # not in the index, so it has to come from the file
+        with open(files.pop("physical_object.yaml").path) as f:
+            system = (yamlio.load(f) or {}).get('system', {})
+        physical_type = report['physical_type'] = system.get('schema_name', '').removesuffix('-media')
+    else:
+        files.pop("physical_object.yaml")
+    report['ok'] += 1
+
+    try:
+        config = profile.get_po_config(physical_type)
+        id_fields = config.id_matcher.match(physical_id)
+    except (KeyError, ValueError) as e:
+        report['error'] = str(e)
+        report['extra'] = sorted(files)
+        return report
+
+    # sequences are expected up to the count in the profile, or whatever
+    # sequences have turned up beyond that.
+    sequences = set(range(1, config.sequence_count + 1))
+    for name in files:
+        fc = classifier.classify(name)
+        # a use without {sequence_id} in its pattern doesn't give one
+        if (fc and fc.sequence_id is not None and fc.physical_object_id == physical_id
+                and physical_type in fc.physical_types):
+            sequences.add(fc.sequence_id)
+
+    for seqno in sorted(sequences):
+        for use, usedata in config.uses.items():
+            name = usedata.pattern.format(**id_fields, sequence_id=seqno)
+            entry = files.pop(name, None)
+            # the QC report isn't required, but it's expected
+            files.pop(name + QC_REPORT_SUFFIX, None)
+            if usedata.optional:
+                if entry is not None:
+                    report['optional'].append(name)
+            elif entry is None:
+                report['missing'].append(name)
+            elif entry.stat().st_size == 0:
+                report['empty'].append(name)
+            else:
+                report['ok'] += 1
+            if usedata.has_metadata:
+                if files.pop(name + ".yaml", None) is None:
+                    report['missing'].append(name + ".yaml")
+                else:
+                    report['ok'] += 1
+
+    report['extra'] = sorted(files)
+    return report
+
+
+def summarize(reports) -> dict:
+    """Total up the physical object reports"""
+    totals = {'physical_objects': 0, 'missing': 0, 'empty': 0, 'extra': 0, 'optional': 0, 'ok': 0, 'errors': 0}
+    for r in reports:
+        totals['physical_objects'] += 1
+        totals['errors'] += 'error' in r
+        totals['ok'] += r['ok']
+        for k in ('missing', 'empty', 'extra', 'optional'):
+            totals[k] += len(r[k])
+    return totals
@@ -0,0 +1,148 @@
+"""
+Timing spans for the hot paths
+
+The interesting operations (Model.patch and write_file, JSON schema
+generation, Profile.get_po_config, ffprobe, YAML parsing and dumping) are
+wrapped in spans.  Tracing is off unless it's enabled by `dwim --profile`
+or by setting DWIM_PROFILE in the environment, and when it's off a span
+costs one flag check.
+
+When it's on, every span is recorded and when the process exits:
+* <prefix>.json has the count, total, mean, and percentiles of each
+  operation (and the peak memory, if tracemalloc is on)
+* <prefix>.trace.json has every span in Chrome trace event format, which
+  can be loaded into chrome://tracing or Perfetto
+
+DWIM_PROFILE is the output prefix (or 1 for dwim-profile-<pid>), and
+DWIM_PROFILE_MEMORY=1 turns on tracemalloc.  Spans nest, so an
+operation's total includes the time in the operations inside it.
+"""
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+import contextlib
+import tracemalloc
+from pathlib import Path
+
+
+_enabled = False
+_prefix: Path = None
+_start_ns = 0
+# (name, start ns, duration ns, thread id), appended from any thread
+_spans: list[tuple[str, int, int, int]] = []
+_NULL = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+
+    def __exit__(self, *exc):
+        _spans.append((self.name, self.start, time.perf_counter_ns() - self.start, threading.get_ident()))
+
+
+def span(name: str):
+    """A context manager which times the block, when tracing is on"""
+    return _Span(name) if _enabled else _NULL
+
+
+def traced(name: str=None):
+    """Decorate a function so each call is a span"""
+    def decorate(func):
+        label = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _spans.append((label, start, time.perf_counter_ns() - start, threading.get_ident()))
+        return wrapper
+    return decorate
+
+
+def enable(prefix: Path=None, memory: bool=False):
+    """Start tracing, writing the results when the process exits"""
+    global _enabled, _prefix, _start_ns
+    if _enabled:
+        return
+    _prefix = Path(prefix or f"dwim-profile-{os.getpid()}")
+    _start_ns = time.perf_counter_ns()
+    if memory:
+        tracemalloc.start()
+    _enabled = True
+    atexit.register(write)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def summary() -> dict:
+    """The count, total, mean, and percentiles (in ms) of each operation"""
+    by_name: dict[str, list[int]] = {}
+    for name, _, duration, _ in list(_spans):
+        by_name.setdefault(name, []).append(duration)
+
+    operations = {}
+    for name, durations in sorted(by_name.items()):
+        durations.sort()
+        n = len(durations)
+        pct = lambda q: durations[min(n - 1, int(q * n))] / 1e6
+        operations[name] = {'count': n,
+                            'total_ms': round(sum(durations) / 1e6, 3),
+                            'mean_ms': round(sum(durations) / n / 1e6, 3),
+                            'p50_ms': round(pct(0.50), 3),
+                            'p90_ms': round(pct(0.90), 3),
+                            'p99_ms': round(pct(0.99), 3),
+                            'max_ms': round(durations[-1] / 1e6, 3)}
+    result = {'wall_ms': round((time.perf_counter_ns() - _start_ns) / 1e6, 3),
+              'operations': operations}
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        result['memory'] = {'current_mb': round(current / 1e6, 3),
+                            'peak_mb': round(peak / 1e6, 3),
+                            'top_allocations': [{'where': str(s.traceback[0]),
+                                                 'size_mb': round(s.size / 1e6, 3),
+                                                 'count': s.count} for s in top]}
+    return result
+
+
+def chrome_trace() -> dict:
+    """Every span, in Chrome trace event format"""
+    pid = os.getpid()
+    return {'traceEvents': [{'name': name, 'cat': 'dwim', 'ph': 'X',
+                             'ts': (start - _start_ns) / 1000, 'dur': duration / 1000,
+                             'pid': pid, 'tid': tid}
+                            for name, start, duration, tid in list(_spans)],
+            'displayTimeUnit': 'ms'}
+
+
+def write():
+    """Write the summary and the trace"""
+    if not _enabled:
+        return
+    with open(f"{_prefix}.json", "w") as f:
+        json.dump(summary(), f, indent=4)
+    with open(f"{_prefix}.trace.json", "w") as f:
+        json.dump(chrome_trace(), f)
+
+
+if os.environ.get("DWIM_PROFILE"):
+    enable(None if os.environ["DWIM_PROFILE"] == "1" else os.environ["DWIM_PROFILE"],
+           memory=os.environ.get("DWIM_PROFILE_MEMORY", '') not in ('', '0'))
@@ -6,17 +6,20 @@ import re
 import luhn
 from enum import Enum
 import string
+from functools import lru_cache
+from pathlib import Path
 
 
-def format_string_to_regex(fmtstring, strmatch='*'):
-    """Given a python format string, convert it to a regex and return field names"""
+def format_string_to_regex(fmtstring, strmatch='*', group_prefix=''):
+    """Given a python format string, convert it to a regex and return field names.
+       The regex group names are prefixed with group_prefix"""
     regex = ""
     groups = {}
     for text, variable, format, conversion in Formatter().parse(fmtstring):
         regex += _escape_regex_text(text)
         if variable:
             vtype = 's'
-            regex += f"(?P<{variable}>"
+            regex += f"(?P<{group_prefix}{variable}>"
             if not format:
                 regex += f".{strmatch}?"
             else:
@@ -26,7 +29,7 @@ def format_string_to_regex(fmtstring, strmatch='*'):
                 fprecision = None
                 if fwidth and '.' in fwidth:
                     fwidth, fprecision = fwidth.split('.')
-                vtype = vtype
+                vtype = ftype
                 match ftype:
                     case 's':
                         if fwidth:
@@ -49,45 +52,109 @@ def format_string_to_regex(fmtstring, strmatch='*'):
     return regex, groups
 
 
+@lru_cache(maxsize=None)
+def compile_format_string(fmtstring: str, exact=False) -> tuple[re.Pattern, dict[str, str]]:
+    """Compile the regex for a format string (anchored at the start, and at
+       the end if exact) and return it with the field names.  The result is
+       cached."""
+    regex, groups = format_string_to_regex(fmtstring)
+    return re.compile("^" + regex + ('$' if exact else '')), groups
+
+
 def _escape_regex_text(text):
-    for c in ('.', '{', '}', '[', ']', '?', '*'):
-        text = text.replace(c, f'\\{c}')
-    return text
+    return re.escape(text)
 
 
-def validate_id(the_id: str, id_pattern: str, id_validators: dict, exact=False) -> dict[str, str]:
-    """Validate an ID pattern using the validators and return the parts and their values"""
-    id_pat, vdata = format_string_to_regex(id_pattern)
-    if m := re.match("^" + id_pat + ('$' if exact else ''), the_id):
+class IdMatcher:
+    """An ID pattern and its validators, compiled once so that many IDs can
+       be checked against them"""
+    # how the matched text is converted for each format type
+    converters = {'s': str, 'd': int, 'f': float}
+
+    def __init__(self, id_pattern: str, id_validators: dict=None, exact=False):
+        self.id_pattern = id_pattern
+        self.regex, self.field_types = compile_format_string(id_pattern, exact)
+        self.validators = []
+        for field, validator in (id_validators or {}).items():
+            vname, *vargs = validator
+            match vname:
+                case 'luhn':
+                    # validate a barcode
+                    self.validators.append((field, self._luhn_validator(field)))
+                case 'regex':
+                    # look for a specific regex
+                    self.validators.append((field, self._regex_validator(field, vargs[0])))
+                case _:
+                    raise ValueError(f"Unknown id validator {vname} for field {field}")
+
+
+    @staticmethod
+    def _luhn_validator(field):
+        def check(value):
+            if not (value.isascii() and value.isdigit()) or not luhn.verify(value):
+                return f"Validation of {field} failed:  Luhn check digit is wrong for '{value}'"
+        return check
+
+
+    @staticmethod
+    def _regex_validator(field, regex):
+        compiled = re.compile(regex)
+        def check(value):
+            if not compiled.match(value):
+                return f"Validation of {field} failed:  regex '{regex}' doesn't match '{value}'"
+        return check
+
+
+    def check(self, the_id: str) -> tuple[dict, list[str]]:
+        """Check an ID, returning its converted parts (or None if it doesn't
+           match the pattern) and a list of the reasons it isn't valid"""
+        m = self.regex.match(the_id)
+        if not m:
+            return None, [f"ID Match for '{the_id}' fails for pattern '{self.id_pattern}'"]
         parts = m.groupdict()
         errors = []
-        if id_validators:
-            for field, validator in id_validators.items():
-                if field in parts:
-                    vname, *vargs = validator
-                    match vname:
-                        case 'luhn':
-                            # validate a barcode
-                            if not luhn.verify(parts[field]):
-                                errors.append(f"Validation of {field} failed:  Luhn check digit is wrong for '{parts[field]}'")
-                        case 'regex':
-                            # look for a specific regex
-                            if not re.match(vargs[0], parts[field]):
-                                errors.append(f"Validation of {field} failed:  regex '{vargs[0]}' doesn't match '{parts[field]}'")
-                        case _:
-                            raise ValueError(f"Unknown id validator {vname} for field {field}")
-        if errors:
-            raise ValueError(f"The id '{the_id}' failed for these reason: \n   *" + "\n    *".join(errors))
-        
+        for field, validator in self.validators:
+            if field in parts and (e := validator(parts[field])):
+                errors.append(e)
+
         # convert values as needed for round-trippery
-        dmap = {'s': str, 'd': int, 'f': 'float'}
-        for k, v in vdata.items():
-            if k in parts and v in dmap:
-                parts[k] = dmap[v](parts[k])
+        for k, v in self.field_types.items():
+            if k in parts and v in self.converters:
+                parts[k] = self.converters[v](parts[k])
+        return parts, errors
 
+
+    def match(self, the_id: str) -> dict:
+        """Validate an ID and return the parts and their values, raising
+           ValueError if it isn't valid"""
+        parts, errors = self.check(the_id)
+        if parts is None:
+            raise ValueError(errors[0])
+        if errors:
+            raise ValueError(f"The id '{the_id}' failed for these reason: \n   *" + "\n    *".join(errors))
         return parts
-    else:
-        raise ValueError(f"ID Match for '{the_id}' fails for pattern '{id_pattern}'")
+
+
+    def check_many(self, ids) -> list[tuple[dict, list[str]]]:
+        """Check a whole column of IDs, returning (parts, errors) for each one
+           in the same order"""
+        check = self.check
+        return [check(the_id) for the_id in ids]
+
+
+_id_matchers: dict[tuple, IdMatcher] = {}
+
+def get_id_matcher(id_pattern: str, id_validators: dict=None, exact=False) -> IdMatcher:
+    """Get a (cached) IdMatcher for the pattern and validators"""
+    key = (id_pattern, exact, tuple((f, tuple(v)) for f, v in (id_validators or {}).items()))
+    if (matcher := _id_matchers.get(key)) is None:
+        matcher = _id_matchers[key] = IdMatcher(id_pattern, id_validators, exact)
+    return matcher
+
+
+def validate_id(the_id: str, id_pattern: str, id_validators: dict, exact=False) -> dict[str, str]:
+    """Validate an ID pattern using the validators and return the parts and their values"""
+    return get_id_matcher(id_pattern, id_validators, exact).match(the_id)
     
 
 def string_enum(classname: str, names: list) -> Enum:
@@ -106,6 +173,16 @@ def string_enum(classname: str, names: list) -> Enum:
     return Enum(classname, {str2identifier(x): x for x in names})
 
 
+def find_project_root(directory: Path) -> Path:
+    """Find the project directory (the one with project.yaml) which contains
+       the given directory, or None if it isn't in a project"""
+    directory = Path(directory).absolute()
+    for d in (directory, *directory.parents):
+        if (d / "project.yaml").exists():
+            return d
+    return None
+
+
 if __name__ == "__main__":    
     regex, fields = format_string_to_regex("MDPI_{barcode:14d}_{sequence:02d}_{use:s}.mp4", strmatch='*')
     print(regex, fields)
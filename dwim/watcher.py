@@ -0,0 +1,267 @@
+"""
+Watch project directories and QC media files as they land
+
+Project.add_sequence creates empty stub files for the media.  When a stub
+is replaced by a real file (copied over it or moved into place), the file
+is probed and checked against the profile's uses.*.qc rules once the writes
+have settled, and the report is written next to the sequence metadata.
+
+Changes are found with inotify on Linux, and by rescanning the directories
+everywhere else (or when the inotify queue overflows).  Files are checked
+by a bounded pool of workers, so a bulk copy doesn't start a probe for
+every file at once.
+"""
+import os
+import time
+import ctypes
+import select
+import struct
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator
+from . import yamlio
+from .qc import qc_report_file, QC_REPORT_SUFFIX
+from .service import DwimService
+
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Just enough of inotify(7) to watch directories for new and changed
+       files.  Raises OSError if inotify isn't available."""
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify isn't available on this system")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: dict[int, str] = {}
+
+
+    def add_watch(self, directory: str):
+        """Watch a directory for changes to the files in it"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+        self._dirs[wd] = directory
+
+
+    def read(self, timeout: float) -> Iterator[tuple[int, str]]:
+        """Wait up to timeout seconds for events, yielding (mask, path).  An
+           overflow is reported as (IN_Q_OVERFLOW, None)."""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        try:
+            buffer = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+            name = buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                yield mask, None
+            elif mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+            elif wd in self._dirs:
+                yield mask, os.path.join(self._dirs[wd], os.fsdecode(name))
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """Watch project roots (or single projects) and QC the media files for
+       a profile as they arrive"""
+    def __init__(self, roots: Iterable[Path], profile: str, workers: int=2,
+                 settle: float=10.0, service: DwimService=None):
+        self.roots = [Path(r).absolute() for r in roots]
+        self.profile = profile
+        self.settle = settle
+        # the service keeps the profile (reloading it when it changes), the
+        # classifier, and the project probe caches.
+        self.service = service or DwimService(max_processes=workers)
+        self.workers = workers
+        self.checked = 0
+        self.failed = 0
+        self._pending: dict[str, tuple[float, tuple]] = {}
+        # the files being checked, and their signatures when they were queued
+        self._in_flight: dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        try:
+            self._inotify = Inotify()
+        except OSError as e:
+            logging.warning(f"Cannot use inotify, the directories will be rescanned instead: {e}")
+            self._inotify = None
+
+
+    def run(self, stop: threading.Event=None):
+        """Watch until stop is set (or forever)"""
+        stop = stop or threading.Event()
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            self.rescan()
+            next_scan = time.monotonic() + self.settle
+            while not stop.is_set():
+                timeout = self._next_deadline() - time.monotonic()
+                timeout = min(max(timeout, 0.05), 1.0)
+                if self._inotify:
+                    for mask, path in self._inotify.read(timeout):
+                        if path is None:
+                            logging.warning("Too many changes for inotify, rescanning")
+                            self.rescan()
+                        elif mask & IN_ISDIR:
+                            if mask & (IN_CREATE | IN_MOVED_TO):
+                                self._watch_tree(path)
+                        else:
+                            self._changed(path)
+                else:
+                    stop.wait(timeout)
+                    if time.monotonic() >= next_scan:
+                        self.rescan(watch=False)
+                        next_scan = time.monotonic() + self.settle
+                for path in self._settled():
+                    pool.submit(self._check, path)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            if self._inotify:
+                self._inotify.close()
+
+
+    def rescan(self, watch: bool=True):
+        """Look at every file under the roots (watching the directories as
+           they're found), and queue the ones which need to be checked"""
+        for root in self.roots:
+            self._watch_tree(str(root), watch)
+
+
+    def _watch_tree(self, directory: str, watch: bool=True):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            # the schemas, caches, and such aren't interesting
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != "schemas"]
+            if watch and self._inotify:
+                try:
+                    self._inotify.add_watch(dirpath)
+                except OSError as e:
+                    logging.warning(e)
+            for name in filenames:
+                self._changed(os.path.join(dirpath, name))
+
+
+    def _changed(self, path: str):
+        """A file may have changed, so (re)start its settle time if it's a
+           media file for the profile"""
+        name = os.path.basename(path)
+        if name.endswith(".yaml") or name.endswith(QC_REPORT_SUFFIX):
+            return
+        if self.service.classifier(self.service.profile(self.profile)).classify(name) is None:
+            return
+        sig = _signature(path)
+        if sig is None or sig[0] == 0:
+            # gone, or still the empty stub
+            return
+        with self._lock:
+            known = path in self._pending or path in self._in_flight
+            last_sig = self._pending[path][1] if path in self._pending else self._in_flight.get(path)
+            if known and last_sig == sig:
+                # nothing new since the last time it was seen
+                return
+        if known or not _report_is_current(path, sig):
+            with self._lock:
+                self._pending[path] = (time.monotonic() + self.settle, sig)
+
+
+    def _next_deadline(self) -> float:
+        with self._lock:
+            return min((d for d, _ in self._pending.values()), default=time.monotonic() + 1.0)
+
+
+    def _settled(self) -> list[str]:
+        """The pending files which haven't changed for the settle time.  A
+           file which changed without an event (on a network filesystem, for
+           instance) waits another settle time."""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (deadline, sig) in list(self._pending.items()):
+                if deadline > now:
+                    continue
+                current = _signature(path)
+                if current is None or current[0] == 0:
+                    del self._pending[path]
+                elif current != sig:
+                    self._pending[path] = (now + self.settle, current)
+                elif path not in self._in_flight:
+                    del self._pending[path]
+                    self._in_flight[path] = sig
+                    ready.append(path)
+        return ready
+
+
+    def _check(self, path: str):
+        """Probe and QC a file, and write its report"""
+        try:
+            sig = _signature(path)
+            report = self.service.qc(self.profile, [path])[0]
+            report = {'checked': datetime.now().isoformat(timespec='seconds'),
+                      'size': sig[0], 'mtime_ns': sig[1],
+                      'passed': not (report.get('error') or report.get('failures')),
+                      **report}
+            report['file'] = os.path.basename(path)
+            write_report(Path(path), report)
+            self.checked += 1
+            if report['passed']:
+                logging.info(f"{path} passed QC")
+            else:
+                self.failed += 1
+                logging.warning(f"{path} failed QC: {report.get('error') or report.get('failures')}")
+        except Exception as e:
+            logging.exception(f"Cannot QC {path}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.pop(path, None)
+
+
+def write_report(file: Path, report: dict):
+    """Write a QC report next to the media file, replacing any old one"""
+    reportfile = qc_report_file(file)
+    tmpfile = reportfile.with_name(f".{reportfile.name}.{os.getpid()}")
+    with open(tmpfile, "w") as f:
+        f.write(yamlio.dump(report))
+    os.replace(tmpfile, reportfile)
+
+
+def _signature(path: str) -> tuple[int, int]:
+    """The size and mtime of a file, or None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _report_is_current(path: str, sig: tuple[int, int]) -> bool:
+    """Check if the file already has a report for this version of it"""
+    try:
+        with open(qc_report_file(path)) as f:
+            report = yamlio.load(f) or {}
+    except FileNotFoundError:
+        return False
+    return (report.get('size'), report.get('mtime_ns')) == sig
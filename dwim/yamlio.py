@@ -0,0 +1,117 @@
+"""
+YAML reading and writing, using libyaml when it's available
+
+The files are read with the C loader when PyYAML was built with libyaml.
+
+Writing is a little trickier:  we indent block sequences under their
+parent key, which the pure python emitter can be convinced to do but
+libyaml can't.  So the C dumper is only used when the data doesn't have
+any block sequences (sets and empty lists are written as flow sequences),
+which makes the output identical either way.  That covers most of the
+sequence and physical object files.
+"""
+import yaml
+if __name__ == "__main__":
+    # run as a script for the self-check below, so the package has to be
+    # importable
+    import sys
+    from pathlib import Path
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+from dwim.trace import traced
+
+try:
+    from yaml import CSafeLoader as FastSafeLoader, CSafeDumper as FastSafeDumper
+    HAVE_LIBYAML = True
+except ImportError:
+    from yaml import SafeLoader as FastSafeLoader, SafeDumper as FastSafeDumper
+    HAVE_LIBYAML = False
+
+
+# do some YAML magic to handle sets...
+class MySafeDumper(yaml.SafeDumper):
+    # Indent arrays per https://stackoverflow.com/questions/25108581/python-yaml-dump-bad-indentation
+    def increase_indent(self, flow=False, indentless=False):
+        return super(MySafeDumper, self).increase_indent(flow, False)
+
+
+class MyFastSafeDumper(FastSafeDumper):
+    """Same representation as MySafeDumper, but libyaml's emitter"""
+
+
+def represent_set(dumper, data):
+    return dumper.represent_sequence(yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, data, flow_style=True)
+    #return dumper.represent_sequence("set", data, flow_style=True)
+
+def represent_list(dumper, data):
+    # we flow if there are only scalars
+    flow = all([type(x) in (str, bool, int, float) for x in data])
+    return dumper.represent_sequence(yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, data, flow_style=flow)
+
+
+MySafeDumper.add_representer(set, represent_set )
+MyFastSafeDumper.add_representer(set, represent_set)
+#MySafeDumper.add_representer(list, represent_list)
+
+DUMP_OPTIONS = {'sort_keys': False,
+                'default_flow_style': False,
+                'allow_unicode': True,
+                'indent': 4,
+                'width': 80}
+
+
+@traced("yaml.load")
+def load(stream):
+    """Load a YAML document (like yaml.safe_load)"""
+    return yaml.load(stream, Loader=FastSafeLoader)
+
+
+@traced("yaml.dump")
+def dump(data, fast=True) -> str:
+    """Dump data in the format used for the model files"""
+    if fast and HAVE_LIBYAML and not has_block_sequence(data):
+        return yaml.dump(data, Dumper=MyFastSafeDumper, **DUMP_OPTIONS)
+    return yaml.dump(data, Dumper=MySafeDumper, **DUMP_OPTIONS)
+
+
+def has_block_sequence(data) -> bool:
+    """Check if any part of the data would be written as a block sequence"""
+    if isinstance(data, dict):
+        return any(has_block_sequence(v) for v in data.values())
+    if isinstance(data, (list, tuple)):
+        return len(data) > 0
+    return False
+
+
+if __name__ == "__main__":
+    # check that both ways of writing produce the same bytes for everything
+    # the models can produce.
+    from dwim.model import Model, model_map
+    from dwim.models import UNSET
+    if not HAVE_LIBYAML:
+        print("libyaml isn't available, only the pure python writer is used")
+        exit(0)
+    samples = []
+    for name in model_map:
+        samples.append(Model(name).data.model_dump())
+    samples.append({'system': {'schema_name': 'x'},
+                    'title': 'A long title that has more than one physical object associated with it, really',
+                    'nested': {'text': "quotes ' and \" and: colons # hashes, unicode éè " * 3,
+                               'empty': [], 'set': {'b', 'a'}, 'number': 1.5, 'flag': True,
+                               'unset': UNSET, 'multi': "line one\nline two"}})
+    failed = 0
+    for data in samples:
+        for d in (data, {**data, 'block': ['a', {'b': 1}]}):
+            fast = yaml.dump(d, Dumper=MyFastSafeDumper, **DUMP_OPTIONS)
+            slow = yaml.dump(d, Dumper=MySafeDumper, **DUMP_OPTIONS)
+            if has_block_sequence(d):
+                if dump(d) != slow:
+                    print(f"FAIL: block sequence data wasn't written with the pure python dumper")
+                    failed += 1
+            elif fast != slow:
+                print(f"FAIL: the outputs differ for {d.get('system')}:\n{fast}\n----\n{slow}")
+                failed += 1
+            if load(dump(d)) != yaml.safe_load(slow):
+                print(f"FAIL: the loaders differ for {d.get('system')}")
+                failed += 1
+    print("FAILED" if failed else "OK")
+    exit(1 if failed else 0)